@@ -1,10 +1,133 @@
+import io
+import os
+
 import streamlit as st
 from PIL import Image
 
+import watermark
+
+# The preview is watermarked at about the display width, full resolution is only rendered for download
+PREVIEW_WIDTH = 1000
+
 st.title("Watermarking App")
 
+
+@st.cache_resource(max_entries=4)
+def decode_image(file_id, _uploaded_file):
+    """Decode an uploaded image once per upload, keyed by its file id, in RGB unless it has transparency."""
+    return watermark.convert_for_watermarking(Image.open(_uploaded_file))
+
+
+@st.cache_resource(max_entries=4)
+def decode_logo(file_id, _uploaded_file):
+    """Decode an uploaded watermark image once per upload, always in RGBA for its alpha mask."""
+    return Image.open(_uploaded_file).convert("RGBA")
+
+
+@st.cache_resource(max_entries=4)
+def preview_image(file_id, _uploaded_file, width):
+    """Downscale the decoded upload once to the preview width."""
+    image = decode_image(file_id, _uploaded_file)
+    if image.width <= width:
+        return image
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+
+
+@st.cache_resource(max_entries=8)
+def text_pattern(size, text, font_size, font_color, outline_color, outline_width, angle, density):
+    """Render the repeating text pattern, independent of the opacity."""
+    return watermark.create_photo_text_watermark(
+        size, text, None, font_size, font_color, outline_color, outline_width, angle, density
+    )
+
+
+@st.cache_resource(max_entries=8)
+def resized_logo(logo_id, _logo_file, base_size, _base_image, scale):
+    """Decode and resize an uploaded watermark image, independent of the opacity."""
+    logo = decode_logo(logo_id, _logo_file)
+    return watermark.resize_watermark(_base_image, logo, scale)
+
+
+def build_layer(image, full_width, settings):
+    """Build the watermark layer and its position for the full image or its preview.
+
+    Text sizes are given for the full image and scaled with the image width, so
+    the preview shows the same pattern as the download.
+    """
+    if settings["mode"] == "Text":
+        if not settings["text"]:
+            return None, None
+        scale = image.width / full_width
+        font_size = max(1, round(settings["font_size"] * scale))
+        outline_width = settings["outline_width"]
+        if outline_width:
+            outline_width = max(1, round(outline_width * scale))
+        layer = text_pattern(image.size, settings["text"], font_size, settings["font_color"],
+                             settings["outline_color"], outline_width, settings["angle"], settings["density"])
+        return layer, (0, 0)
+
+    logo_file = settings["logo_file"]
+    if not logo_file:
+        return None, None
+    layer = resized_logo(logo_file.file_id, logo_file, image.size, image, settings["scale"])
+    return layer, watermark.calculate_position(image, layer, settings["position"])
+
+
+def encode_image(image, file_name):
+    """Encode an image in the format of the uploaded file name."""
+    output = io.BytesIO()
+    if file_name.lower().endswith((".jpg", ".jpeg")):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(output, format="JPEG", quality=95)
+    else:
+        image.save(output, format="PNG")
+    return output.getvalue()
+
+
 uploaded_file = st.file_uploader("Upload an image", type=["png", "jpg", "jpeg"])
 
 if uploaded_file:
-    image = Image.open(uploaded_file)
-    st.image(image, caption="Uploaded Image", use_column_width=True)
\ No newline at end of file
+    settings = {"mode": st.sidebar.radio("Watermark type", ["Text", "Image"])}
+    opacity = st.sidebar.slider("Opacity", 0.0, 1.0, watermark.DEFAULT_OPACITY, 0.05)
+
+    if settings["mode"] == "Text":
+        settings["text"] = st.sidebar.text_input("Text", "© Your Name")
+        settings["font_size"] = st.sidebar.slider("Font size", 8, 200, watermark.DEFAULT_FONT_SIZE)
+        settings["font_color"] = st.sidebar.color_picker("Font color", watermark.DEFAULT_FONT_COLOR)
+        settings["outline_color"] = st.sidebar.color_picker("Outline color", watermark.DEFAULT_TEXT_OUTLINE_COLOR)
+        settings["outline_width"] = st.sidebar.slider("Outline width", 0, 10, watermark.DEFAULT_TEXT_OUTLINE_WIDTH)
+        settings["angle"] = st.sidebar.slider("Angle", -90, 90, watermark.DEFAULT_TEXT_ANGLE)
+        settings["density"] = st.sidebar.slider("Density", 0.1, 1.0, watermark.DEFAULT_DENSITY, 0.05)
+    else:
+        settings["logo_file"] = st.sidebar.file_uploader("Watermark image", type=["png", "jpg", "jpeg"])
+        settings["scale"] = st.sidebar.slider("Scale", 0.05, 1.0, watermark.DEFAULT_SCALE, 0.05)
+        settings["position"] = st.sidebar.selectbox(
+            "Position", ["center", "top-left", "top-right", "bottom-left", "bottom-right"]
+        )
+
+    full_image = decode_image(uploaded_file.file_id, uploaded_file)
+    preview = preview_image(uploaded_file.file_id, uploaded_file, PREVIEW_WIDTH)
+
+    # Only the small preview is composited again when a slider moves
+    layer, position = build_layer(preview, full_image.width, settings)
+    if layer is None:
+        st.image(preview, caption="Uploaded Image", width="stretch")
+    else:
+        st.image(watermark.apply_watermark(preview, layer, position, opacity),
+                 caption="Watermarked Preview", width="stretch")
+
+        logo_file = settings.get("logo_file")
+        export_key = (uploaded_file.file_id, opacity, logo_file.file_id if logo_file else None,
+                      tuple(value for name, value in sorted(settings.items()) if name != "logo_file"))
+        if st.button("Prepare full-resolution download"):
+            layer, position = build_layer(full_image, full_image.width, settings)
+            result = watermark.apply_watermark(full_image, layer, position, opacity)
+            st.session_state["export"] = (export_key, encode_image(result, uploaded_file.name))
+
+        # Offer the export only while it still matches the current settings
+        export = st.session_state.get("export")
+        if export and export[0] == export_key:
+            name, ext = os.path.splitext(uploaded_file.name)
+            st.download_button("Download", export[1], file_name=f"{name}_wm{ext}")
\ No newline at end of file
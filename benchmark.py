@@ -0,0 +1,451 @@
+"""
+Benchmarks for the Photography Watermarking Script
+
+Measures the time and memory of the watermarking steps on synthetic images, so
+no sample photos are needed. Each measurement runs in a fresh process, which
+keeps the peak memory of one run from hiding the peak of the next.
+
+Example Usage:
+    python benchmark.py composite
+    python benchmark.py composite --size 8000x6000 --repeat 3
+    python benchmark.py outline
+    python benchmark.py modes
+    python benchmark.py stages --json before.json
+    python benchmark.py stages --matrix full --json after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py startup
+"""
+
+import argparse
+import compileall
+import functools
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak memory is then not reported
+    resource = None
+
+from PIL import Image, ImageChops, ImageStat
+
+import watermark
+
+# Constants
+DEFAULT_SIZE = '6000x4000'
+DEFAULT_REPEAT = 5
+BENCHMARK_TEXT = '© Benchmark Photography'
+OUTLINE_FONT_SIZES = [24, 96]
+OUTLINE_WIDTHS = [1, 3, 5]
+# Largest per-channel difference from the 'offset' outline, and the difference 99.9% of the
+# channel values stay within, for an outline mode to count as looking the same
+OUTLINE_MAX_DIFFERENCE = 32
+OUTLINE_P999_DIFFERENCE = 8
+# Modes that must look like 'offset', besides the default mode. 'stroke' is only reported.
+OUTLINE_PARITY_MODES = ['dilate']
+# Stage benchmarks vary one parameter at a time around this case
+BASE_CASE = {'megapixels': 12, 'angle': 45, 'density': 0.5, 'outline_width': 1, 'font_size': 24}
+STAGE_MATRICES = {
+    'quick': {'megapixels': [1, 12, 24], 'angle': [0, 30], 'density': [0.2, 0.9],
+              'outline_width': [3], 'font_size': [96]},
+    'full': {'megapixels': [1, 12, 24, 50, 100], 'angle': [0, 30, 60], 'density': [0.2, 0.8, 1.0],
+             'outline_width': [3, 5], 'font_size': [48, 96]},
+}
+# The text opacity is applied inside create_photo_text_watermark, like the script does.
+# set_opacity is timed on the full-size layer, as image watermarks still use it.
+STAGES = ['load_image', 'create_single_text_watermark', 'create_photo_text_watermark',
+          'set_opacity', 'apply_watermark', 'save_image']
+DEFAULT_THRESHOLD = 0.10  # Relative slowdown that compare reports as a regression
+DEFAULT_MAX_STARTUP_MS = 25  # Import time of watermark.py above which startup fails
+# Modules that only some commands need, and that watermark.py --help must not import
+DEFERRED_MODULES = ['PIL', 'numpy', 'asyncio', 'concurrent.futures', 'http.server', 'multiprocessing',
+                    'hashlib', 'cProfile']
+# Runs the command line like `python watermark.py --help`, but as an import that -X importtime reports
+STARTUP_SCRIPT = "import sys; sys.argv = ['watermark.py', '--help']; import watermark; watermark.main()"
+
+
+def main():
+    """Entry point of the benchmarks."""
+    args = parse_arguments()
+    size = parse_size(args.size)
+
+    if args.benchmark == 'composite':
+        backends = ['pil', 'numpy'] if watermark.import_numpy() is not None else ['pil']
+        results = [run_isolated(benchmark_composite, size, args.repeat, backend) for backend in backends]
+        print_results(f"Opacity + composite, {size[0]}x{size[1]}", results)
+    elif args.benchmark == 'modes':
+        results = [run_isolated(benchmark_modes, size, args.repeat, keep_rgb) for keep_rgb in (False, True)]
+        print_results(f"JPEG load + composite + save, {size[0]}x{size[1]}", results)
+    elif args.benchmark == 'stages':
+        results = []
+        for case in stage_cases(args.matrix):
+            result = run_isolated(benchmark_stages, case, args.repeat)
+            print_stage_result(result)
+            results.append(result)
+        if args.json:
+            write_report(args.json, results)
+    elif args.benchmark == 'compare':
+        regressions = compare_reports(args.reports[0], args.reports[1], args.threshold)
+        sys.exit(1 if regressions else 0)
+    elif args.benchmark == 'startup':
+        sys.exit(0 if benchmark_startup(args.repeat, args.max_startup_ms) else 1)
+    elif args.benchmark == 'outline':
+        # Fails when the default mode or a parity mode does not look like 'offset'
+        checked_modes = set(OUTLINE_PARITY_MODES) | {watermark.DEFAULT_OUTLINE_MODE}
+        failed_modes = set()
+        for font_size in OUTLINE_FONT_SIZES:
+            for outline_width in OUTLINE_WIDTHS:
+                results = [benchmark_outline(font_size, outline_width, mode, args.repeat)
+                           for mode in watermark.OUTLINE_MODES]
+                print_results(f"Outline, font size {font_size}, width {outline_width}", results,
+                              extras=[('mean diff', 'mean_difference'), ('max diff', 'max_difference'),
+                                      ('p99.9 diff', 'p999_difference'), ('parity', 'parity')])
+                failed_modes.update(result['name'] for result in results
+                                    if result['name'] in checked_modes and result['parity'] != 'ok')
+        print(f"Parity limits vs offset: max {OUTLINE_MAX_DIFFERENCE}, p99.9 {OUTLINE_P999_DIFFERENCE}. "
+              f"Checked modes {', '.join(sorted(checked_modes))}: "
+              + (f"{', '.join(sorted(failed_modes))} DIFFER" if failed_modes else "ok"))
+        sys.exit(1 if failed_modes else 0)
+
+
+def parse_arguments():
+    """Parse command-line arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark the watermarking steps on synthetic images.")
+    parser.add_argument('benchmark', choices=['composite', 'modes', 'outline', 'stages', 'compare', 'startup'], help="Benchmark to run.")
+    parser.add_argument('reports', nargs='*', help="For compare: the baseline and the new JSON report.")
+    parser.add_argument('--matrix', choices=sorted(STAGE_MATRICES), default='quick',
+                        help="For stages: which parameter matrix to run. Default: quick")
+    parser.add_argument('--json', help="For stages: write the results to this JSON file.")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"For compare: relative slowdown reported as a regression. Default: {DEFAULT_THRESHOLD}")
+    parser.add_argument('--max-startup-ms', type=float, default=DEFAULT_MAX_STARTUP_MS,
+                        help=f"For startup: the longest acceptable import time in ms. Default: {DEFAULT_MAX_STARTUP_MS}")
+    parser.add_argument('--size', default=DEFAULT_SIZE,
+                        help=f"Image size as WIDTHxHEIGHT. Default: {DEFAULT_SIZE}")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f"Number of timed runs per measurement. Default: {DEFAULT_REPEAT}")
+    args = parser.parse_args()
+    if args.benchmark == 'compare' and len(args.reports) != 2:
+        parser.error("compare needs a baseline and a new report")
+    return args
+
+
+def parse_size(size):
+    """Parse a WIDTHxHEIGHT string into a tuple."""
+    width, height = size.lower().split('x')
+    return int(width), int(height)
+
+
+def run_isolated(function, *args):
+    """Run a benchmark function in a fresh process and return its result."""
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of the current process in MB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def synthetic_image(size, mode='RGBA'):
+    """Create a noisy test image that does not compress to nothing."""
+    return Image.effect_noise(size, 64).convert(mode)
+
+
+def benchmark_composite(size, repeat, backend):
+    """Time set_opacity + apply_watermark for a full-size text watermark."""
+    base_image = synthetic_image(size)
+    layer = watermark.create_photo_text_watermark(
+        size, BENCHMARK_TEXT, None, watermark.DEFAULT_FONT_SIZE, watermark.DEFAULT_FONT_COLOR,
+        watermark.DEFAULT_TEXT_OUTLINE_COLOR, watermark.DEFAULT_TEXT_OUTLINE_WIDTH,
+        watermark.DEFAULT_TEXT_ANGLE, watermark.DEFAULT_DENSITY
+    )
+    rss_before = peak_rss_mb()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if backend == 'numpy':
+            result = watermark.apply_watermark(base_image, layer, (0, 0), watermark.DEFAULT_OPACITY, 'numpy')
+        else:
+            result = watermark.apply_watermark(base_image, watermark.set_opacity(layer, watermark.DEFAULT_OPACITY), (0, 0))
+        timings.append(time.perf_counter() - start)
+        del result
+
+    rss_after = peak_rss_mb()
+    return {
+        'name': backend,
+        'seconds': statistics.median(timings),
+        'peak_growth_mb': None if rss_before is None else rss_after - rss_before,
+    }
+
+
+def benchmark_modes(size, repeat, keep_rgb):
+    """Time a JPEG round trip with the base image in RGB, or converted to RGBA and back."""
+    layer = watermark.create_photo_text_watermark(
+        size, BENCHMARK_TEXT, None, watermark.DEFAULT_FONT_SIZE, watermark.DEFAULT_FONT_COLOR,
+        watermark.DEFAULT_TEXT_OUTLINE_COLOR, watermark.DEFAULT_TEXT_OUTLINE_WIDTH,
+        watermark.DEFAULT_TEXT_ANGLE, watermark.DEFAULT_DENSITY, opacity=watermark.DEFAULT_OPACITY
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, 'input.jpg')
+        output_path = os.path.join(directory, 'output.jpg')
+        synthetic_image(size, 'RGB').save(input_path, quality=90)
+        rss_before = peak_rss_mb()
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            base_image = watermark.load_image(input_path, keep_rgb=keep_rgb)
+            result = watermark.apply_watermark(base_image, layer, (0, 0))
+            watermark.save_image(result, output_path)
+            timings.append(time.perf_counter() - start)
+            del base_image, result
+
+    rss_after = peak_rss_mb()
+    return {
+        'name': 'rgb' if keep_rgb else 'rgba',
+        'seconds': statistics.median(timings),
+        'peak_growth_mb': None if rss_before is None else rss_after - rss_before,
+    }
+
+
+def stage_cases(matrix):
+    """Return the base case plus one case per varied parameter value."""
+    cases = [dict(BASE_CASE)]
+    for name, values in STAGE_MATRICES[matrix].items():
+        for value in values:
+            if value != BASE_CASE[name]:
+                cases.append(dict(BASE_CASE, **{name: value}))
+    return cases
+
+
+def size_for_megapixels(megapixels):
+    """Return a 3:2 image size with about the given number of megapixels."""
+    height = int((megapixels * 1000000 / 1.5) ** 0.5)
+    return int(height * 1.5), height
+
+
+def benchmark_stages(case, repeat):
+    """Time every step of a text watermark run separately for one case."""
+    size = size_for_megapixels(case['megapixels'])
+    timings = {stage: [] for stage in STAGES}
+
+    def timed(stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        timings[stage].append(time.perf_counter() - start)
+        return result
+
+    with tempfile.TemporaryDirectory() as directory:
+        input_path = os.path.join(directory, 'input.jpg')
+        synthetic_image(size, 'RGB').save(input_path, quality=90)
+        pattern_args = (
+            BENCHMARK_TEXT, None, case['font_size'], watermark.DEFAULT_FONT_COLOR,
+            watermark.DEFAULT_TEXT_OUTLINE_COLOR, case['outline_width'], case['angle'], case['density'],
+            watermark.DEFAULT_OUTLINE_MODE, watermark.DEFAULT_OPACITY
+        )
+
+        for _ in range(repeat):
+            # Every repeat starts cold, otherwise the pattern cache would be timed
+            watermark.clear_watermark_cache()
+            watermark.lattice_counters.clear()
+            font = watermark.get_system_font(case['font_size'])
+
+            base_image = timed('load_image', watermark.load_image, input_path, True)
+            timed('create_single_text_watermark', watermark.create_single_text_watermark,
+                  BENCHMARK_TEXT, font, case['font_size'], watermark.DEFAULT_FONT_COLOR,
+                  watermark.DEFAULT_TEXT_OUTLINE_COLOR, case['outline_width'])
+            layer = timed('create_photo_text_watermark', watermark.create_photo_text_watermark,
+                          base_image.size, *pattern_args)
+            timed('set_opacity', watermark.set_opacity, layer, watermark.DEFAULT_OPACITY)
+            result = timed('apply_watermark', watermark.apply_watermark, base_image, layer, (0, 0))
+            timed('save_image', watermark.save_image, result, os.path.join(directory, 'output.jpg'))
+            del base_image, layer, result
+
+    return {
+        'case': case,
+        'size': list(size),
+        'stages': {stage: statistics.median(values) for stage, values in timings.items()},
+        'lattice_counters': dict(watermark.lattice_counters),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def case_label(case):
+    """Return a short label for a stage benchmark case."""
+    return (f"{case['megapixels']}MP angle={case['angle']} density={case['density']} "
+            f"outline={case['outline_width']} font={case['font_size']}")
+
+
+def print_stage_result(result):
+    """Print the stage timings of one case."""
+    peak = result['peak_rss_mb']
+    print(f"{case_label(result['case'])}  peak RSS: " + (f"{peak:.0f} MB" if peak is not None else "n/a"))
+    for stage, seconds in result['stages'].items():
+        print(f"  {stage:<30}{seconds:10.4f} s")
+    counters = result.get('lattice_counters', {})
+    print(f"  lattice lines / tiles pasted  {counters.get('lines', 0):>6} / {counters.get('pastes', 0)}")
+
+
+def write_report(path, results):
+    """Write stage results with enough context to compare them between commits."""
+    report = {
+        'python': platform.python_version(),
+        'pillow': Image.__version__,
+        'platform': platform.platform(),
+        'results': results,
+    }
+    with open(path, 'w', encoding='utf-8') as report_file:
+        json.dump(report, report_file, indent=2)
+
+
+def compare_reports(baseline_path, new_path, threshold):
+    """Print the per-stage change between two reports and return the regressions."""
+    with open(baseline_path, encoding='utf-8') as report_file:
+        baseline = {case_label(result['case']): result for result in json.load(report_file)['results']}
+    with open(new_path, encoding='utf-8') as report_file:
+        new = {case_label(result['case']): result for result in json.load(report_file)['results']}
+
+    regressions = []
+    for label in sorted(baseline.keys() & new.keys()):
+        print(label)
+        metrics = dict(baseline[label]['stages'], peak_rss_mb=baseline[label]['peak_rss_mb'])
+        new_metrics = dict(new[label]['stages'], peak_rss_mb=new[label]['peak_rss_mb'])
+        for metric, old_value in metrics.items():
+            new_value = new_metrics.get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = new_value / old_value - 1
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions.append((label, metric, change))
+            print(f"  {metric:<30}{old_value:10.4f} -> {new_value:10.4f}  {change:+7.1%}{flag}")
+
+    print(f"{len(regressions)} regression(s) above {threshold:.0%}.")
+    return regressions
+
+
+def benchmark_startup(repeat, max_startup_ms):
+    """Time the imports of watermark.py --help with -X importtime and check them against the limits.
+
+    Returns whether the median import time stays below max_startup_ms and none of
+    the deferred modules were imported.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    # Time the imports, not compiling watermark.py to bytecode
+    compileall.compile_file(os.path.join(directory, 'watermark.py'), quiet=1)
+
+    import_times, wall_times, deferred = [], [], set()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT], cwd=directory,
+                                   capture_output=True, text=True, check=True)
+        wall_times.append(time.perf_counter() - start)
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line:
+                continue
+            _, cumulative, module = line.split('|')
+            module = module.strip()
+            if module == 'watermark':
+                import_times.append(int(cumulative) / 1000)
+            deferred.update(name for name in DEFERRED_MODULES
+                            if module == name or module.startswith(name + '.'))
+
+    import_ms = statistics.median(import_times)
+    print(f"watermark.py --help, median of {repeat} runs")
+    print(f"  {'import watermark':<30}{import_ms:10.1f} ms  (limit {max_startup_ms:g} ms)")
+    print(f"  {'whole process':<30}{statistics.median(wall_times) * 1000:10.1f} ms")
+    if deferred:
+        print(f"  Imported modules that should be deferred: {', '.join(sorted(deferred))}")
+    passed = import_ms <= max_startup_ms and not deferred
+    print("OK" if passed else "REGRESSION")
+    return passed
+
+
+def benchmark_outline(font_size, outline_width, outline_mode, repeat):
+    """Time one outline mode and measure how far it looks from the 'offset' mode."""
+    font = watermark.get_system_font(font_size)
+    render = functools.partial(
+        watermark.create_single_text_watermark, BENCHMARK_TEXT, font, font_size,
+        watermark.DEFAULT_FONT_COLOR, watermark.DEFAULT_TEXT_OUTLINE_COLOR, outline_width
+    )
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tile = render(outline_mode)
+        timings.append(time.perf_counter() - start)
+
+    mean_difference, max_difference, p999_difference = visible_difference(render('offset'), tile)
+    within_limits = max_difference <= OUTLINE_MAX_DIFFERENCE and p999_difference <= OUTLINE_P999_DIFFERENCE
+    return {
+        'name': outline_mode,
+        'seconds': statistics.median(timings),
+        'peak_growth_mb': None,
+        'mean_difference': mean_difference,
+        'max_difference': max_difference,
+        'p999_difference': p999_difference,
+        'parity': 'ok' if within_limits else 'DIFFERS',
+    }
+
+
+def visible_difference(expected, actual):
+    """Return the mean, largest and 99.9th percentile per-channel difference of two RGBA images.
+
+    Colors are weighted by alpha first, so fully transparent pixels compare equal
+    whatever color they carry.
+    """
+    def premultiplied(image):
+        red, green, blue, alpha = image.split()
+        bands = [ImageChops.multiply(band, alpha) for band in (red, green, blue)]
+        return Image.merge('RGBA', bands + [alpha])
+
+    difference = ImageChops.difference(premultiplied(expected), premultiplied(actual))
+    histogram = [sum(counts) for counts in zip(*(band.histogram() for band in difference.split()))]
+    total = sum(histogram)
+    max_difference = max(value for value, count in enumerate(histogram) if count)
+    counted = 0
+    for p999_difference, count in enumerate(histogram):
+        counted += count
+        if counted >= total * 0.999:
+            break
+    return sum(ImageStat.Stat(difference).mean) / 4, max_difference, p999_difference
+
+
+def print_results(title, results, extras=()):
+    """Print benchmark results as a small table.
+
+    extras are (column title, result key) pairs for more columns.
+    """
+    print(title)
+    header = f"  {'variant':<12}{'median s':>12}{'peak +MB':>12}"
+    for column, _ in extras:
+        header += f"{column:>12}"
+    print(header)
+    for result in results:
+        growth = result['peak_growth_mb']
+        growth = f"{growth:12.1f}" if growth is not None else f"{'n/a':>12}"
+        line = f"  {result['name']:<12}{result['seconds']:12.3f}{growth}"
+        for _, key in extras:
+            value = result[key]
+            line += f"{value:12.3f}" if isinstance(value, float) else f"{value:>12}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
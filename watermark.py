@@ -24,13 +24,28 @@ Example Usage:
     python watermark.py -i photo.jpg -t "SAMPLE" --density 0.8 --opacity 0.3 --angle 45
 """
 
+# Only cheap modules are imported here. PIL, NumPy, asyncio, http.server and the
+# other heavy imports happen in the functions that need them, so --help and
+# argument errors return quickly and every run only pays for the code it uses.
 import argparse
-from PIL import Image, ImageDraw, ImageFont, ImageColor, ImageFilter
+import collections
+import contextlib
+import copy
+import functools
+import glob
+import io
+import json
 import os
 import math
+import mmap
 import sys
-import textwrap
-from pathlib import Path
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, memory growth is then not profiled
+    resource = None
 
 # Constants
 DEFAULT_WATERMARK_PATH = 'watermark-logo.png'
@@ -45,59 +60,826 @@ DEFAULT_TEXT_ANGLE = 45  # 45-degree angle is standard for photo watermarks
 DEFAULT_DENSITY = 0.5  # Controls spacing between repeats (lower = more space)
 DEFAULT_TEXT_OUTLINE_WIDTH = 1  # Thinner outline for subtlety
 DEFAULT_TEXT_OUTLINE_COLOR = '#000000'  # Black outline
+DEFAULT_OUTLINE_MODE = 'dilate'  # Same outline as the original offset drawing, built in a few mask passes
+OUTLINE_MODES = ['dilate', 'stroke', 'offset']
 SUPPORTED_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+TILE_CACHE_SIZE = 32  # Rotated text tiles are small, keep plenty of them
+PATTERN_CACHE_MB = 128  # Finished patterns are image-sized, the cache is bounded by their total size
+DEFAULT_BACKEND = 'pil'
+NUMPY_STRIP_HEIGHT = 256  # Rows composited per step, bounds the numpy temporaries
+FONT_CACHE_SIZE = 16
+DEFAULT_THREADS = 1
+BANDS_PER_THREAD = 2  # More bands than threads evens out bands with more or less text
+DEFAULT_MEMORY_BUDGET = None  # MB, None processes the whole image at once
+BAND_BYTES_PER_PIXEL = 8  # A band's pattern plus the seed band it is tiled from, both RGBA
+MIN_BAND_HEIGHT = 16
+DEFAULT_LONG_EDGE = None
+DEFAULT_SERVER_HOST = '127.0.0.1'
+DEFAULT_SERVER_PORT = 8080
+DEFAULT_SERVER_WORKERS = 4
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+# Query parameters a request may override, with their types
+REQUEST_PARAMETERS = {
+    'text': str, 'font_size': int, 'font_color': str, 'outline_color': str, 'outline_width': int,
+    'outline_mode': str, 'angle': float, 'density': float, 'opacity': float, 'long_edge': int,
+}
+# Inclusive ranges of request parameters, so a single request cannot tie up a worker for long.
+# Offset outlines draw the text once per offset, their cost grows with the square of the width.
+REQUEST_LIMITS = {'font_size': (1, 500), 'outline_width': (0, 10), 'opacity': (0.0, 1.0), 'long_edge': (1, None)}
+MAX_REQUEST_TEXT_LENGTH = 200
+MAX_REQUEST_TILE_PIXELS = 32 * 1000 * 1000  # Rotated text tile, bounds what long text at a large size costs
+PIPELINE_QUEUE_SIZE = 1
+OUTPUT_FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'), 'jpg': ('JPEG', 'image/jpeg'), 'png': ('PNG', 'image/png'),
+    'webp': ('WEBP', 'image/webp'), 'avif': ('AVIF', 'image/avif'),
+}
+OUTPUT_EXTENSIONS = {'jpeg': '.jpg', 'png': '.png', 'webp': '.webp', 'avif': '.avif'}
+# Encoder settings per profile and Pillow format, formats that are not listed use Pillow's defaults
+ENCODER_PROFILES = {
+    'fast': {
+        'JPEG': {'quality': 85, 'subsampling': '4:2:0', 'optimize': False},
+        'PNG': {'compress_level': 1},
+        'WEBP': {'quality': 80, 'method': 0},
+        'AVIF': {'quality': 70, 'speed': 10},
+    },
+    'balanced': {
+        'JPEG': {'quality': 90, 'subsampling': '4:2:0', 'optimize': True},
+        'PNG': {'compress_level': 6},
+        'WEBP': {'quality': 85, 'method': 4},
+        'AVIF': {'quality': 75, 'speed': 6},
+    },
+    'smallest': {
+        'JPEG': {'quality': 80, 'subsampling': '4:2:0', 'optimize': True, 'progressive': True},
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'WEBP': {'quality': 75, 'method': 6},
+        'AVIF': {'quality': 60, 'speed': 2},
+    },
+}
+DEFAULT_ENCODER_PROFILE = 'balanced'
+# Stages recorded by --profile, in the order they are reported ('write' only for the
+# pipeline's buffered encodes, direct saves count their file write under 'encode')
+PROFILE_STAGES = ['load', 'font', 'tile_render', 'rotate', 'tile_placement', 'opacity', 'composite',
+                  'encode', 'write']
+DEFAULT_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of --profile-sample
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'streamlit-watermark'
+)
+FONT_PATH_CACHE_FILE = os.path.join(CACHE_DIR, 'font-path')
+DEFAULT_LAYER_CACHE_DIR = os.path.join(CACHE_DIR, 'layers')
+DEFAULT_LAYER_CACHE_SIZE = 2048  # MB, least recently used layers are removed beyond this
+LAYER_CACHE_VERSION = 3  # Bump when the rendering changes, so old layers are no longer used
+LAYER_WRITE_ROWS = 256  # Rows converted to bytes at a time when storing a layer
+# Common font locations and names, in order of preference
+SYSTEM_FONT_CANDIDATES = [
+    # Windows fonts
+    "Arial.ttf", "arial.ttf",
+    "Verdana.ttf", "verdana.ttf",
+    "Tahoma.ttf", "tahoma.ttf",
+    "Times.ttf", "times.ttf",
+    "TimesNewRoman.ttf", "timesnewroman.ttf",
+    # Linux fonts
+    "DejaVuSans.ttf", "DejaVuSans-Bold.ttf",
+    # Mac fonts
+    "Helvetica.ttf", "helvetica.ttf",
+    # System paths
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/TTF/Arial.ttf",
+    "/System/Library/Fonts/Helvetica.ttf",
+    "C:\\Windows\\Fonts\\arial.ttf",
+    "C:\\Windows\\Fonts\\verdana.ttf"
+]
 
 
 def main():
     """Entry point of the script."""
+    if sys.argv[1:2] == ['serve']:
+        args = parse_serve_arguments(sys.argv[2:])
+        with python_profilers(args):
+            serve(args)
+        return
+
     args = parse_arguments()
+    with python_profilers(args):
+        watermark_images(args)
+
+
+def watermark_images(args):
+    """Watermark the input file or the batch of inputs given on the command line."""
+    if args.profile:
+        enable_profiling()
 
     try:
-        base_image = load_image(args.input)
-
-        # Determine if using text or image watermark
-        if args.text:
-            # Generate diagonal repeating text watermark (photography style)
-            watermark = create_photo_text_watermark(
-                base_image.size,
-                args.text,
-                args.font,
-                args.font_size,
-                args.font_color,
-                args.outline_color,
-                args.outline_width,
-                args.angle,
-                args.density
-            )
-
-            # Apply opacity to the watermark
-            watermark = set_opacity(watermark, args.opacity)
+        input_paths = collect_input_paths(args.input)
+        if not input_paths:
+            raise FileNotFoundError(f"No images found for '{args.input}'.")
+
+        # A single plain file keeps the original one-shot behaviour
+        if len(input_paths) == 1 and os.path.isfile(args.input) and not args.output_dir:
+            output_path = args.output or default_output_path(args.input, output_format=args.format)
+            stats = watermark_file(args.input, output_path, args)
+            print(f"Watermark applied successfully! Saved to {output_path}")
+            if args.encode_report:
+                write_encode_report(args, [dict(stats, input=args.input)])
+        elif args.output:
+            raise ValueError("--output only works with a single input file; use --output-dir instead.")
+        else:
+            run_batch(args, input_paths)
 
-            # For text watermarks, we always center the pattern over the entire image
-            position = (0, 0)  # Full overlay starting at top-left
+        if args.profile:
+            report_profile(args.profile)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+def build_watermark(args, base_image):
+    """Build the opacity-adjusted watermark and its position for a base image.
+
+    Only the size of base_image is used, so a lazily opened image is enough.
+    With the numpy backend the opacity is left for apply_watermark.
+    """
+    # Determine if using text or image watermark
+    if args.text:
+        # Generate diagonal repeating text watermark (photography style)
+        pattern_args = (
+            base_image.size,
+            args.text,
+            args.font,
+            args.font_size,
+            args.font_color,
+            args.outline_color,
+            args.outline_width,
+            args.angle,
+            args.density,
+            args.outline_mode,
+            # The numpy backend applies the opacity while compositing
+            args.opacity if args.backend != 'numpy' else 1.0
+        )
+        if args.layer_cache:
+            watermark = cached_text_watermark(args.layer_cache, args.layer_cache_size, *pattern_args)
         else:
-            # Use image watermark
-            watermark = load_image(args.watermark)
-            watermark = resize_watermark(base_image, watermark, args.scale)
+            watermark = create_photo_text_watermark(*pattern_args)
+
+        # For text watermarks, we always center the pattern over the entire image
+        position = (0, 0)  # Full overlay starting at top-left
+    else:
+        # Use image watermark
+        watermark = load_image(args.watermark)
+        watermark = resize_watermark(base_image, watermark, args.scale)
+        if args.backend != 'numpy':
             watermark = set_opacity(watermark, args.opacity)
-            position = calculate_position(base_image, watermark, args.position)
+        position = calculate_position(base_image, watermark, args.position)
 
-        # Apply the watermark
-        watermarked_image = apply_watermark(base_image, watermark, position)
+    return watermark, position
 
-        # Determine output path
-        if args.output:
-            output_path = args.output
-        else:
-            input_name, input_ext = os.path.splitext(args.input)
-            output_ext = input_ext if input_ext.lower() in SUPPORTED_EXTENSIONS else '.png'
-            output_path = f"{input_name}_wm{output_ext}"
 
-        save_image(watermarked_image, output_path)
+def watermark_file(input_path, output_path, args, prepared=None):
+    """Watermark a single image file, save the result and return its encode stats.
+
+    prepared maps image sizes to (watermark, position) pairs that were built ahead of time.
+    """
+    if args.memory_budget:
+        return watermark_file_in_bands(input_path, output_path, args)
+
+    base_image = load_image(input_path, keep_rgb=True, long_edge=args.long_edge)
+    return save_image(composite_image(base_image, args, prepared), output_path,
+                      args.encoder_profile, args.optimize)
+
+
+def composite_image(base_image, args, prepared=None):
+    """Build or look up the watermark for an image and return the watermarked image.
+
+    With args.direct or more than one thread, text is pasted onto base_image in
+    place and base_image is returned.
+    """
+    if args.text and args.direct:
+        composite_text_watermark(
+            base_image, args.text, args.font, args.font_size, args.font_color, args.outline_color,
+            args.outline_width, args.angle, args.density, args.opacity, args.outline_mode
+        )
+        return base_image
+
+    if args.text and args.threads > 1 and not (prepared and base_image.size in prepared):
+        band_height = max(MIN_BAND_HEIGHT, -(-base_image.height // (args.threads * BANDS_PER_THREAD)))
+        composite_text_in_bands(base_image, args, band_height, args.threads)
+        return base_image
+
+    if prepared and base_image.size in prepared:
+        watermark, position = prepared[base_image.size]
+    else:
+        watermark, position = build_watermark(args, base_image)
+
+    # Apply the watermark, build_watermark already applied the opacity for the PIL backend
+    opacity = args.opacity if args.backend == 'numpy' else 1.0
+    return apply_watermark(base_image, watermark, position, opacity, args.backend)
+
+
+def watermark_file_in_bands(input_path, output_path, args):
+    """Watermark a single image band by band to keep the working memory near args.memory_budget MB.
+
+    Pillow cannot decode or encode part of an image, so the decoded image is kept
+    once. The text pattern only ever exists for one band per thread, and every
+    band is composited in place.
+    """
+    base_image = load_image(input_path, keep_rgb=True, long_edge=args.long_edge)
+    base_width, base_height = base_image.size
+
+    if args.text and args.direct:
+        # Direct compositing never builds more than one tile, bands would not save anything
+        composite_image(base_image, args)
+    elif args.text:
+        # Every thread has a band in flight, so they share the budget
+        band_height = band_height_for_budget(base_width, args.memory_budget / args.threads)
+        composite_text_in_bands(base_image, args, band_height, args.threads)
+    else:
+        watermark, position = build_watermark(args, base_image)
+        if args.backend == 'numpy':  # build_watermark left the opacity for the compositing step
+            watermark = set_opacity(watermark, args.opacity)
+        with profile_stage('composite'):
+            base_image.paste(watermark, position, watermark)
+
+    return save_image(base_image, output_path, args.encoder_profile, args.optimize)
 
-        print(f"Watermark applied successfully! Saved to {output_path}")
+
+def composite_text_in_bands(base_image, args, band_height, threads=1):
+    """Render the text pattern band by band and paste every band onto base_image in place.
+
+    With more than one thread the bands are rendered and pasted concurrently.
+    Pillow releases the GIL while pasting, and the bands cover separate rows.
+    """
+    import concurrent.futures
+
+    base_width, base_height = base_image.size
+    boxes = [(0, top, base_width, min(top + band_height, base_height))
+             for top in range(0, base_height, band_height)]
+
+    def composite_band(box):
+        band = create_photo_text_watermark_region(
+            box, args.text, args.font, args.font_size, args.font_color, args.outline_color,
+            args.outline_width, args.angle, args.density, args.outline_mode, args.opacity
+        )
+        with profile_stage('composite'):
+            base_image.paste(band, box[:2], band)
+
+    if threads > 1:
+        base_image.load()  # Load before the threads share the image
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(composite_band, boxes))
+    else:
+        for box in boxes:
+            composite_band(box)
+
+
+def band_height_for_budget(width, memory_budget):
+    """Return how many rows of a band fit in the memory budget given in MB."""
+    band_height = int(memory_budget * 1024 * 1024) // (width * BAND_BYTES_PER_PIXEL)
+    return max(MIN_BAND_HEIGHT, band_height)
+
+
+def default_output_path(input_path, input_root=None, output_dir=None, output_format=None):
+    """Return the output path for an input image.
+
+    With an output directory the source tree below input_root is mirrored,
+    otherwise '_wm' is appended next to the input file. The input format is
+    kept unless an output format is given.
+    """
+    input_name, input_ext = os.path.splitext(input_path)
+    if output_format:
+        output_ext = OUTPUT_EXTENSIONS[output_format]
+    else:
+        output_ext = input_ext if input_ext.lower() in SUPPORTED_EXTENSIONS else '.png'
+    if output_dir:
+        relative_name = os.path.relpath(input_name, input_root or os.path.dirname(input_path))
+        return os.path.join(output_dir, relative_name + output_ext)
+    return f"{input_name}_wm{output_ext}"
+
+
+def collect_input_paths(input_spec):
+    """Expand a file, directory or glob pattern into a sorted list of image paths."""
+    if os.path.isfile(input_spec):
+        return [input_spec]
+
+    if os.path.isdir(input_spec):
+        candidates = []
+        for directory, _, filenames in os.walk(input_spec):
+            candidates.extend(os.path.join(directory, filename) for filename in filenames)
+    else:
+        candidates = [path for path in glob.glob(input_spec, recursive=True) if os.path.isfile(path)]
+
+    # Skip earlier results so re-running over the same tree does not stack watermarks
+    return sorted(
+        path for path in candidates
+        if os.path.splitext(path)[1].lower() in SUPPORTED_EXTENSIONS
+        and not os.path.splitext(path)[0].endswith('_wm')
+    )
+
+
+def input_root(input_spec):
+    """Return the directory that output paths are mirrored from."""
+    from pathlib import Path
+
+    if os.path.isdir(input_spec):
+        return input_spec
+    if os.path.isfile(input_spec):
+        return os.path.dirname(input_spec)
+
+    # For glob patterns, use the leading part of the path without wildcards
+    root_parts = []
+    for part in Path(input_spec).parts:
+        if any(char in part for char in '*?['):
+            break
+        root_parts.append(part)
+    return os.path.join(*root_parts) if root_parts else '.'
+
+
+def run_batch(args, input_paths):
+    """Watermark many images, optionally spread over a pool of worker processes."""
+    import asyncio
+    import concurrent.futures
+    from PIL import Image
+
+    root = input_root(args.input)
+    jobs = [(path, default_output_path(path, root, args.output_dir, args.format)) for path in input_paths]
+
+    # Build the watermark once for every image size that occurs more than once.
+    # Sizes are read from the file headers, the pixel data is not decoded here
+    # unless the images are shrunk to a long edge.
+    paths_by_size = {}
+    for path in input_paths:
+        try:
+            with Image.open(path) as image:
+                paths_by_size.setdefault(reduced_size(image.size, args.long_edge), []).append(path)
+        except IOError:
+            continue
+    prepared = _prepare_watermarks(args, paths_by_size)
+
+    failures = 0
+    encode_stats = []
+    if args.jobs > 1:
+        # Every watermark is copied once into shared memory, which all workers map
+        # without a copy, so the memory does not grow with the number of workers
+        blocks = []
+        try:
+            shared = {}
+            for size, (watermark, position) in prepared.items():
+                block = _share_image(watermark)
+                blocks.append(block)
+                shared[size] = (watermark.mode, watermark.size, block.name, position)
+            # The parent's copies, including the cached patterns, are no longer needed
+            prepared = watermark = None
+            clear_watermark_cache()
+
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=args.jobs, initializer=_init_batch_worker, initargs=(args, shared)) as executor:
+                futures = {executor.submit(_batch_worker, input_path, output_path): input_path
+                           for input_path, output_path in jobs}
+                for future in concurrent.futures.as_completed(futures):
+                    error, stats, profile = future.result()
+                    merge_profile(profile)
+                    failures += _report_batch_result(futures[future], error, stats, encode_stats)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    elif args.memory_budget:
+        for input_path, output_path in jobs:
+            try:
+                error, stats = None, watermark_file(input_path, output_path, args)
+            except Exception as e:
+                error, stats = str(e), None
+            failures += _report_batch_result(input_path, error, stats, encode_stats)
+    else:
+        failures, encode_stats = asyncio.run(run_pipeline(jobs, args, prepared))
+
+    print(f"Watermarked {len(jobs) - failures} of {len(jobs)} images.")
+    if args.encode_report:
+        write_encode_report(args, encode_stats)
+
+
+def _prepare_watermarks(args, paths_by_size):
+    """Build the watermark once for every image size that occurs more than once.
+
+    Returns a dict that maps image sizes to (watermark, position) pairs. Nothing is
+    built under a memory budget, watermark_file_in_bands never uses full-size
+    watermarks and holding them would only add to the memory the budget limits.
+    """
+    from PIL import Image
+
+    if args.memory_budget:
+        return {}
+    prepared = {}
+    for size, paths in paths_by_size.items():
+        if len(paths) > 1 and not (args.text and (args.direct or args.threads > 1)):
+            # build_watermark only reads the size, which is known from the headers,
+            # so a blank stand-in avoids decoding and resizing an image here
+            watermark, position = build_watermark(args, Image.new('1', size))
+            if args.text and args.layer_cache:
+                continue  # Workers map the layer from the cache that was just filled
+            prepared[size] = (watermark, position)
+    return prepared
+
+
+def write_encode_report(args, encode_stats):
+    """Write the encoder settings and the per-image encode time and size of a run as JSON."""
+    report = {
+        'encoder_profile': args.encoder_profile,
+        'optimize': args.optimize,
+        'images': encode_stats,
+        'total_encode_seconds': round(sum(stats['encode_seconds'] for stats in encode_stats), 4),
+        'total_bytes': sum(stats['bytes'] for stats in encode_stats),
+    }
+    with open(args.encode_report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Encoded {len(encode_stats)} images in {report['total_encode_seconds']:.2f}s, "
+          f"{report['total_bytes'] / 1024 / 1024:.1f} MB written. Report saved to {args.encode_report}")
+
+
+_batch_args = None
+_batch_prepared = None
+_batch_blocks = []  # Shared memory behind the prepared watermarks, kept open while they are used
+
+
+def _set_batch_state(args, prepared):
+    """Store the arguments and the pre-built watermarks for _batch_worker."""
+    global _batch_args, _batch_prepared
+    _batch_args = args
+    _batch_prepared = prepared
+
+
+def _init_batch_worker(args, shared):
+    """Map the pre-built watermarks from shared memory in a worker process.
+
+    shared maps image sizes to (mode, size, shared memory name, position).
+    """
+    import multiprocessing.shared_memory
+    from PIL import Image
+
+    if args.profile:
+        enable_profiling(worker=True)
+    prepared = {}
+    for size, (mode, watermark_size, name, position) in shared.items():
+        # Workers use the parent's resource tracker, attaching registers the block a
+        # second time, which is harmless, and the parent's unlink unregisters it
+        block = multiprocessing.shared_memory.SharedMemory(name=name)
+        _batch_blocks.append(block)
+        watermark = Image.frombuffer(mode, watermark_size, block.buf, 'raw', mode, 0, 1)
+        prepared[size] = (watermark, position)
+    _set_batch_state(args, prepared)
+
+
+def _share_image(image):
+    """Copy an image's pixels into a new shared memory block, a few rows at a time."""
+    import multiprocessing.shared_memory
+
+    row_bytes = image.width * len(image.getbands())
+    block = multiprocessing.shared_memory.SharedMemory(create=True, size=max(1, row_bytes * image.height))
+    for top in range(0, image.height, LAYER_WRITE_ROWS):
+        bottom = min(top + LAYER_WRITE_ROWS, image.height)
+        block.buf[top * row_bytes:bottom * row_bytes] = image.crop((0, top, image.width, bottom)).tobytes()
+    return block
+
+
+def _batch_worker(input_path, output_path):
+    """Watermark one image of a batch.
+
+    Returns an error message, the encode stats and, in a profiled worker process,
+    the profile recorded since the last image.
+    """
+    try:
+        stats = watermark_file(input_path, output_path, _batch_args, _batch_prepared)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        return str(e), None, take_profile()
+    finally:
+        # Sizes that occur more than once are prepared, so a pattern rendered here is not needed again
+        clear_pattern_cache()
+    return None, stats, take_profile()
+
+
+async def run_pipeline(jobs, args, prepared=None):
+    """Watermark (input_path, output_path) jobs in overlapping stages.
+
+    Returns the number of failures and the encode stats of the saved images.
+
+    Reading, decoding, compositing, encoding and writing each run on their own
+    thread, connected by small bounded queues, so one image is read while the
+    previous one is composited and the one before that is written. Pillow
+    releases the GIL while decoding, encoding and compositing, and the bounded
+    queues keep only a few decoded images in memory at a time.
+    """
+    import asyncio
+
+    stages = [
+        lambda job, _: read_file(job[0]),
+        lambda job, data: decode_image(data, job[0], args.long_edge),
+        lambda job, image: composite_image(image, args, prepared),
+        lambda job, image: encode_for_path(image, job[1], args.encoder_profile, args.optimize),
+        lambda job, encoded: _write_encoded(job[1], *encoded),
+    ]
+    queues = [asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) for _ in range(len(stages) + 1)]
+    failures = []
+    encode_stats = []
+
+    async def feed():
+        for job in jobs:
+            await queues[0].put((job, None))
+        await queues[0].put(None)
+
+    async def drain():
+        while (item := await queues[-1].get()) is not None:
+            job, stats = item
+            encode_stats.append(dict(stats, input=job[0]))
+
+    await asyncio.gather(
+        feed(),
+        *(_pipeline_stage(stage, inbox, outbox, failures)
+          for stage, inbox, outbox in zip(stages, queues, queues[1:])),
+        drain(),
+    )
+    return len(failures), encode_stats
+
+
+async def _pipeline_stage(stage, inbox, outbox, failures):
+    """Run one pipeline stage on its own thread until the end of the input."""
+    import asyncio
+    import concurrent.futures
+
+    loop = asyncio.get_running_loop()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            item = await inbox.get()
+            if item is None:
+                await outbox.put(None)
+                return
+            job, value = item
+            try:
+                value = await loop.run_in_executor(executor, stage, job, value)
+            except Exception as e:
+                failures.append(_report_batch_result(job[0], str(e)))
+                continue
+            await outbox.put((job, value))
+
+
+def _write_encoded(output_path, data, stats):
+    """Write the bytes from the encode stage and pass its stats on."""
+    write_file(output_path, data)
+    return stats
+
+
+def _report_batch_result(input_path, error, stats=None, encode_stats=None):
+    """Print the outcome for one batch image, collect its encode stats and return 1 if it failed."""
+    if error:
+        print(f"An error occurred with {input_path}: {error}")
+        return 1
+    if encode_stats is not None:
+        encode_stats.append(dict(stats, input=input_path))
+    return 0
+
+
+@contextlib.contextmanager
+def python_profilers(args):
+    """Run the enclosed code under cProfile and the stack sampler when args ask for them."""
+    with contextlib.ExitStack() as stack:
+        if args.profile_sample:
+            stack.enter_context(sample_stacks(args.profile_sample, args.sample_interval))
+        if args.profile_out:
+            stack.enter_context(cprofile_to(args.profile_out))
+        yield
+
+
+@contextlib.contextmanager
+def cprofile_to(output_path):
+    """Profile the enclosed code with cProfile and dump the stats to output_path for pstats."""
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(output_path)
+        print(f"Python profile saved to {output_path}, view it with: python -m pstats {output_path}")
+
+
+@contextlib.contextmanager
+def sample_stacks(output_path, interval=DEFAULT_SAMPLE_INTERVAL):
+    """Sample the stacks of all threads while the enclosed code runs and write them to output_path.
+
+    The file has one collapsed stack per line followed by its sample count, the input
+    format of flamegraph.pl, speedscope and similar tools. Unlike cProfile, sampling
+    also sees the pipeline and band threads and barely slows the program down.
+    """
+    if interval <= 0:
+        raise ValueError("The sample interval must be positive.")
+    counts = collections.Counter()
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_stacks, args=(counts, stop, interval),
+                               name='stack-sampler', daemon=True)
+    sampler.start()
+    try:
+        yield counts
+    finally:
+        stop.set()
+        sampler.join()
+        with open(output_path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write(f"{stack} {count}\n")
+        print(f"{sum(counts.values())} stack samples saved to {output_path}")
+
+
+def _sample_stacks(counts, stop, interval):
+    """Count the current stack of every other thread until stop is set."""
+    own_ident = threading.get_ident()
+    while not stop.wait(interval):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            counts[';'.join(reversed(stack))] += 1
+
+
+_profile = None  # Per-stage totals while profiling is enabled
+_profile_is_worker = False
+_profile_lock = threading.Lock()
+_profile_local = threading.local()
+
+
+def enable_profiling(worker=False):
+    """Start recording stage timings, discarding earlier ones.
+
+    A worker process hands its recordings to the parent with take_profile.
+    """
+    global _profile, _profile_is_worker
+    _profile = {}
+    _profile_is_worker = worker
+    with _profile_lock:
+        lattice_counters.clear()
+
+
+@contextlib.contextmanager
+def profile_stage(stage):
+    """Record the wall time, CPU time and peak memory growth of a stage while profiling is enabled.
+
+    Times are exclusive, a stage nested in another one is only counted for itself.
+    """
+    if _profile is None:
+        yield
+        return
+
+    nested = [0.0, 0.0]  # Wall and CPU time of the stages inside this one
+    stack = _profile_local.__dict__.setdefault('stack', [])
+    stack.append(nested)
+    start_wall, start_cpu, start_rss = time.perf_counter(), time.thread_time(), _peak_rss_mb()
+    try:
+        yield
+    finally:
+        stack.pop()
+        wall = time.perf_counter() - start_wall
+        cpu = time.thread_time() - start_cpu
+        if stack:
+            stack[-1][0] += wall
+            stack[-1][1] += cpu
+        growth = _peak_rss_mb() - start_rss if start_rss is not None else None
+        with _profile_lock:
+            _add_stage(_profile, stage, {
+                'calls': 1, 'wall_seconds': wall - nested[0], 'cpu_seconds': cpu - nested[1],
+                'peak_rss_growth_mb': growth,
+            })
+
+
+def profiled(stage):
+    """Decorate a function so its calls are recorded as a profiling stage."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profile_stage(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _add_stage(profile, stage, totals):
+    """Add the totals of one or more calls of a stage to a profile."""
+    entry = profile.setdefault(stage, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                       'peak_rss_growth_mb': None})
+    entry['calls'] += totals['calls']
+    entry['wall_seconds'] += totals['wall_seconds']
+    entry['cpu_seconds'] += totals['cpu_seconds']
+    if totals['peak_rss_growth_mb'] is not None:
+        entry['peak_rss_growth_mb'] = max(entry['peak_rss_growth_mb'] or 0.0, totals['peak_rss_growth_mb'])
+
+
+def _peak_rss_mb():
+    """Return the peak resident memory of this process in MB, or None if it is unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def profile_snapshot():
+    """Return the stages and lattice counters recorded so far."""
+    with _profile_lock:
+        return {
+            'stages': {stage: dict(totals) for stage, totals in (_profile or {}).items()},
+            'lattice': {
+                'lines': lattice_counters['lines'],
+                'tiles_pasted': lattice_counters['pastes'],
+                'tiles_skipped': lattice_counters['skipped'],
+                'band_copies': lattice_counters['band_copies'],
+            },
+            'peak_rss_mb': _peak_rss_mb(),
+        }
+
+
+def take_profile():
+    """In a profiled worker process, return the recordings so far and start over, otherwise None."""
+    if _profile is None or not _profile_is_worker:
+        return None
+    profile = profile_snapshot()
+    enable_profiling(worker=True)
+    return profile
+
+
+def merge_profile(profile):
+    """Add the recordings of a worker process to this process's profile."""
+    if profile is None or _profile is None:
+        return
+    with _profile_lock:
+        for stage, totals in profile['stages'].items():
+            _add_stage(_profile, stage, totals)
+        for name, key in (('lines', 'lines'), ('pastes', 'tiles_pasted'), ('skipped', 'tiles_skipped'),
+                          ('band_copies', 'band_copies')):
+            lattice_counters[name] += profile['lattice'][key]
+
+
+def report_profile(destination):
+    """Print the profile as a table, or write it as JSON when destination is a file name."""
+    profile = profile_snapshot()
+    if destination == '-':
+        print(format_profile_table(profile))
+        return
+    with open(destination, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print(f"Profile saved to {destination}")
+
+
+def format_profile_table(profile):
+    """Format a profile as a human-readable table."""
+    stages = sorted(profile['stages'].items(),
+                    key=lambda item: PROFILE_STAGES.index(item[0]) if item[0] in PROFILE_STAGES else len(PROFILE_STAGES))
+    lines = [f"{'stage':<16}{'calls':>8}{'wall s':>10}{'cpu s':>10}{'peak +MB':>10}"]
+    for stage, totals in stages:
+        growth = totals['peak_rss_growth_mb']
+        growth = f"{growth:10.1f}" if growth is not None else f"{'n/a':>10}"
+        lines.append(f"{stage:<16}{totals['calls']:>8}{totals['wall_seconds']:10.3f}"
+                     f"{totals['cpu_seconds']:10.3f}{growth}")
+    lattice = profile['lattice']
+    lines.append(f"Lattice tiles pasted / skipped: {lattice['tiles_pasted']} / {lattice['tiles_skipped']}, "
+                 f"{lattice['band_copies']} band copies")
+    if profile['peak_rss_mb'] is not None:
+        lines.append(f"Peak RSS: {profile['peak_rss_mb']:.0f} MB")
+    return "\n".join(lines)
+
+
+def format_prometheus(profile, request_counts=None):
+    """Format a profile, and the number of requests per status code, in the Prometheus text format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+
+    stages = profile['stages']
+    metric('watermark_stage_calls_total', 'counter', 'Calls of each watermarking stage.',
+           [(f'stage="{stage}"', totals['calls']) for stage, totals in stages.items()])
+    metric('watermark_stage_seconds_total', 'counter', 'Wall time spent in each stage, excluding nested stages.',
+           [(f'stage="{stage}"', totals['wall_seconds']) for stage, totals in stages.items()])
+    metric('watermark_stage_cpu_seconds_total', 'counter', 'CPU time spent in each stage, excluding nested stages.',
+           [(f'stage="{stage}"', totals['cpu_seconds']) for stage, totals in stages.items()])
+    metric('watermark_stage_peak_rss_growth_megabytes', 'gauge',
+           'Largest growth of the peak resident memory during one call of each stage.',
+           [(f'stage="{stage}"', totals['peak_rss_growth_mb']) for stage, totals in stages.items()
+            if totals['peak_rss_growth_mb'] is not None])
+    lattice = profile['lattice']
+    metric('watermark_lattice_tiles_total', 'counter', 'Text tiles pasted or skipped while tiling patterns.',
+           [('result="pasted"', lattice['tiles_pasted']), ('result="skipped"', lattice['tiles_skipped'])])
+    if profile['peak_rss_mb'] is not None:
+        metric('watermark_peak_rss_megabytes', 'gauge', 'Peak resident memory of the server.',
+               [('', profile['peak_rss_mb'])])
+    if request_counts is not None:
+        metric('watermark_requests_total', 'counter', 'HTTP responses by status code.',
+               [(f'code="{code}"', count) for code, count in sorted(request_counts.items())])
+    return "\n".join(lines) + "\n"
 
 
 def parse_arguments():
@@ -110,16 +892,30 @@ Examples:
   python watermark.py -i photo.jpg -t "© Jane Doe Photography" 
   python watermark.py -i photo.jpg -t "SAMPLE" --density 0.8 --opacity 0.25 --angle 45
 
+  # Batch watermark a whole shoot with 8 worker processes
+  python watermark.py -i shoot/ -t "© Jane Doe Photography" --output-dir proofs/ --jobs 8
+
+  # Small WebP proofs, with the encode time and size of every image saved to a report
+  python watermark.py -i shoot/ -t "© Jane Doe" --output-dir proofs/ --long-edge 2048 \\
+      --format webp --encoder-profile smallest --encode-report encode.json
+
+  # Investigate a slow image: stage table, cProfile stats and a flamegraph-ready stack file
+  python watermark.py -i slow.jpg -t "© Jane Doe" --profile --profile-out slow.prof --profile-sample slow.folded
+
   # Legacy image watermark functionality
   python watermark.py -i photo.jpg -w custom_watermark.png -p bottom-right -s 0.2 -a 0.7
 
+  # Keep fonts and patterns warm in a local HTTP server (see: python watermark.py serve --help)
+  python watermark.py serve -t "© Jane Doe Photography" --port 8080
+
 For more information, use the -h or --help option with each argument.
         """,
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
 
     # Required arguments
-    parser.add_argument('-i', '--input', required=True, help="Path to the input image.")
+    parser.add_argument('-i', '--input', required=True,
+                        help="Path to the input image, a directory of images or a glob pattern (e.g., 'shoot/**/*.jpg').")
 
     # Watermark group - either image or text
     watermark_group = parser.add_mutually_exclusive_group()
@@ -127,6 +923,55 @@ For more information, use the -h or --help option with each argument.
                                  help=f"Path to the watermark image. Default: {DEFAULT_WATERMARK_PATH}")
     watermark_group.add_argument('-t', '--text', help="Text to use as watermark (e.g., '© Your Name')")
 
+    add_text_arguments(parser)
+
+    # Common options
+    parser.add_argument('-o', '--output',
+                        help="Path to save the watermarked image. If not provided, '_wm' will be appended to the input filename.")
+    parser.add_argument('--output-dir',
+                        help="Directory to save watermarked images to, mirroring the input directory tree.")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes for directory and glob inputs. Default: 1")
+    parser.add_argument('-p', '--position',
+                        choices=['top-left', 'top-right', 'bottom-left', 'bottom-right', 'center'],
+                        default=DEFAULT_POSITION,
+                        help=f"Position for image watermarks (ignored for text watermarks). Default: {DEFAULT_POSITION}")
+    parser.add_argument('-s', '--scale', type=float, default=DEFAULT_SCALE,
+                        help=f"Scale factor for image watermarks (0 to 1). Default: {DEFAULT_SCALE}")
+    parser.add_argument('-a', '--opacity', type=float, default=DEFAULT_OPACITY,
+                        help=f"Opacity level for the watermark (0 to 1). Default: {DEFAULT_OPACITY}")
+    parser.add_argument('--long-edge', '--max-size', type=int, default=DEFAULT_LONG_EDGE,
+                        help="Shrink images so their longer side is at most this many pixels before "
+                             "watermarking. JPEGs are decoded directly at a reduced scale. Default: full size")
+    parser.add_argument('--format', choices=sorted(OUTPUT_EXTENSIONS),
+                        help="Output format for generated output paths. Default: the input format")
+    parser.add_argument('--encode-report',
+                        help="Write the encode time and size of every saved image to this JSON file")
+    add_encoder_arguments(parser)
+    add_layer_cache_arguments(parser)
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="Render and composite text watermarks in bands on this many threads, "
+                             "which speeds up single very large images. With more than one thread, text "
+                             "watermarks ignore --layer-cache and --backend. "
+                             f"Default: {DEFAULT_THREADS}")
+    parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                        help="Record the time and memory of every stage and print them as a table, "
+                             "or write them to FILE as JSON")
+    add_profiler_arguments(parser)
+    parser.add_argument('--memory-budget', type=float, default=DEFAULT_MEMORY_BUDGET,
+                        help="Process images in horizontal bands that use about this many MB on top of "
+                             "the decoded image. Default: process the whole image at once")
+    parser.add_argument('--backend', choices=['pil', 'numpy'], default=DEFAULT_BACKEND,
+                        help=f"Compositing backend. 'numpy' needs NumPy and uses less memory. Default: {DEFAULT_BACKEND}")
+
+    args = parser.parse_args()
+    if args.jobs < 1 or args.threads < 1:
+        parser.error("--jobs and --threads must be at least 1")
+    return args
+
+
+def add_text_arguments(parser):
+    """Add the text watermark options to a parser."""
     # Text watermark specific options
     text_group = parser.add_argument_group('Text Watermark Options')
     text_group.add_argument('--font', default=DEFAULT_FONT_PATH,
@@ -139,14 +984,82 @@ For more information, use the -h or --help option with each argument.
                             help=f"Outline color for text in hex format. Default: {DEFAULT_TEXT_OUTLINE_COLOR}")
     text_group.add_argument('--outline-width', type=int, default=DEFAULT_TEXT_OUTLINE_WIDTH,
                             help=f"Width of text outline in pixels. Default: {DEFAULT_TEXT_OUTLINE_WIDTH}")
+    text_group.add_argument('--outline-mode', choices=OUTLINE_MODES, default=DEFAULT_OUTLINE_MODE,
+                            help="How the outline is drawn. 'offset' is the original method and draws the text once "
+                                 "per outline pixel. 'dilate' builds the same outline from one glyph mask, to within "
+                                 "a few levels per channel, and is much faster for wide outlines. 'stroke' uses "
+                                 "FreeType's stroker, which is fastest but changes the outline edges visibly "
+                                 f"(see benchmark.py outline). Default: {DEFAULT_OUTLINE_MODE}")
     text_group.add_argument('--angle', type=float, default=DEFAULT_TEXT_ANGLE,
                             help=f"Rotation angle for text watermark in degrees. Default: {DEFAULT_TEXT_ANGLE}")
     text_group.add_argument('--density', type=float, default=DEFAULT_DENSITY,
                             help=f"Density of the repeating pattern (0.1-1.0). Lower values create more space between text. Default: {DEFAULT_DENSITY}")
+    text_group.add_argument('--direct', action='store_true',
+                            help="Paste the text straight onto the image instead of building full-size watermark "
+                                 "layers. Uses far less memory; where copies of the text overlap (very high "
+                                 "densities) they blend slightly differently.")
+
+
+def add_encoder_arguments(parser):
+    """Add the output encoder options to a parser."""
+    parser.add_argument('--encoder-profile', choices=sorted(ENCODER_PROFILES), default=DEFAULT_ENCODER_PROFILE,
+                        help="Encoder settings: 'fast' encodes quickest, 'smallest' writes the smallest files. "
+                             f"Default: {DEFAULT_ENCODER_PROFILE}")
+    parser.add_argument('--no-optimize', dest='optimize', action='store_false',
+                        help="Skip the extra optimize pass of the JPEG and PNG encoders for faster saves")
+
+
+def add_profiler_arguments(parser):
+    """Add the options that profile the Python code itself to a parser."""
+    parser.add_argument('--profile-out', metavar='FILE',
+                        help="Run under cProfile and dump the stats to FILE for pstats, snakeviz and similar "
+                             "tools. Only this process is profiled, not the worker processes of -j")
+    parser.add_argument('--profile-sample', metavar='FILE',
+                        help="Sample the stacks of all threads and write them to FILE as collapsed stacks "
+                             "for flamegraph.pl or speedscope")
+    parser.add_argument('--sample-interval', type=float, default=DEFAULT_SAMPLE_INTERVAL, metavar='SECONDS',
+                        help=f"Time between stack samples of --profile-sample. Default: {DEFAULT_SAMPLE_INTERVAL}")
+
+
+def add_layer_cache_arguments(parser):
+    """Add the on-disk layer cache options to a parser."""
+    parser.add_argument('--layer-cache', nargs='?', const=DEFAULT_LAYER_CACHE_DIR, metavar='DIR',
+                        help="Keep finished text watermark layers in this directory, so later runs and other "
+                             f"processes load them instead of rendering. Without DIR: {DEFAULT_LAYER_CACHE_DIR}")
+    parser.add_argument('--layer-cache-size', type=float, default=DEFAULT_LAYER_CACHE_SIZE, metavar='MB',
+                        help=f"Size limit of the layer cache in MB. Default: {DEFAULT_LAYER_CACHE_SIZE}")
+
+
+def parse_serve_arguments(argv):
+    """Parse the command-line arguments of the serve command."""
+    parser = argparse.ArgumentParser(
+        prog="watermark.py serve",
+        description="Run a local HTTP server that watermarks images posted to /watermark.",
+        epilog="""
+Example:
+  python watermark.py serve -t "© Jane Doe Photography" --port 8080 --workers 4
+  curl --data-binary @photo.jpg "http://127.0.0.1:8080/watermark?opacity=0.25&angle=30" -o photo_wm.jpg
+
+The options below are the defaults for every request. Requests can override
+the text options, the opacity and the long edge with query parameters of the
+same name, using underscores (e.g. font_size=32, long_edge=2048), plus
+format=jpeg|png|webp|avif for the output.
+        """,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--host', default=DEFAULT_SERVER_HOST,
+                        help=f"Address to listen on. Default: {DEFAULT_SERVER_HOST}")
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVER_PORT,
+                        help=f"Port to listen on. Default: {DEFAULT_SERVER_PORT}")
+    parser.add_argument('--workers', type=int, default=DEFAULT_SERVER_WORKERS,
+                        help=f"Number of images watermarked at the same time. Default: {DEFAULT_SERVER_WORKERS}")
+
+    watermark_group = parser.add_mutually_exclusive_group()
+    watermark_group.add_argument('-w', '--watermark', default=DEFAULT_WATERMARK_PATH,
+                                 help=f"Path to the watermark image used when a request has no text. Default: {DEFAULT_WATERMARK_PATH}")
+    watermark_group.add_argument('-t', '--text', help="Default text to use as watermark (e.g., '© Your Name')")
+    add_text_arguments(parser)
 
-    # Common options
-    parser.add_argument('-o', '--output',
-                        help="Path to save the watermarked image. If not provided, '_wm' will be appended to the input filename.")
     parser.add_argument('-p', '--position',
                         choices=['top-left', 'top-right', 'bottom-left', 'bottom-right', 'center'],
                         default=DEFAULT_POSITION,
@@ -155,55 +1068,379 @@ For more information, use the -h or --help option with each argument.
                         help=f"Scale factor for image watermarks (0 to 1). Default: {DEFAULT_SCALE}")
     parser.add_argument('-a', '--opacity', type=float, default=DEFAULT_OPACITY,
                         help=f"Opacity level for the watermark (0 to 1). Default: {DEFAULT_OPACITY}")
-
-    args = parser.parse_args()
+    parser.add_argument('--long-edge', '--max-size', type=int, default=DEFAULT_LONG_EDGE,
+                        help="Shrink images so their longer side is at most this many pixels before "
+                             "watermarking. JPEGs are decoded directly at a reduced scale. Default: full size")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="Render and composite text watermarks in bands on this many threads, "
+                             "which speeds up single very large images. With more than one thread, text "
+                             "watermarks ignore --layer-cache and --backend. "
+                             f"Default: {DEFAULT_THREADS}")
+    add_layer_cache_arguments(parser)
+    add_encoder_arguments(parser)
+    parser.add_argument('--backend', choices=['pil', 'numpy'], default=DEFAULT_BACKEND,
+                        help=f"Compositing backend. 'numpy' needs NumPy and uses less memory. Default: {DEFAULT_BACKEND}")
+    add_profiler_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.threads < 1:
+        parser.error("--workers and --threads must be at least 1")
     return args
 
 
-def load_image(image_path):
-    """Load an image from the specified path."""
+def serve(args):
+    """Run the watermarking HTTP server until interrupted.
+
+    Fonts, rendered text tiles and patterns stay cached between requests, and
+    at most args.workers request bodies are read and watermarked at the same
+    time. Stage timings are always recorded and served in the Prometheus text
+    format at /metrics.
+    """
+    import concurrent.futures
+    import http.server
+
+    enable_profiling()
+    server = http.server.ThreadingHTTPServer((args.host, args.port), request_handler_class())
+    server.defaults = args
+    server.executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.workers)
+    server.request_slots = threading.BoundedSemaphore(args.workers)
+    server.request_counts = collections.Counter()
+    print(f"Serving watermarks on http://{args.host}:{args.port}/watermark")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown()
+
+
+@functools.lru_cache(maxsize=None)
+def request_handler_class():
+    """Define the request handler of the server, importing http.server only when serving."""
+    import http.server
+    import urllib.parse
+
+    class WatermarkRequestHandler(http.server.BaseHTTPRequestHandler):
+        """Watermark the image in the body of POST /watermark and return the result."""
+
+        def do_GET(self):
+            """Answer health checks and serve the metrics."""
+            path = urllib.parse.urlsplit(self.path).path
+            if path == '/health':
+                self._send(200, b'ok', 'text/plain')
+            elif path == '/metrics':
+                metrics = format_prometheus(profile_snapshot(), dict(self.server.request_counts))
+                self._send(200, metrics.encode(), 'text/plain; version=0.0.4')
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            """Watermark the posted image with the server defaults and the query parameters."""
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != '/watermark':
+                self.send_error(404)
+                return
+
+            length = int(self.headers.get('Content-Length') or 0)
+            if not length:
+                self.send_error(411, "The image must be sent as the request body")
+                return
+            if length > MAX_REQUEST_BYTES:
+                self.send_error(413)
+                return
+
+            try:
+                args, output_format = request_arguments(self.server.defaults, url.query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+
+            # Every connection has its own thread, only args.workers of them may hold a body at a time
+            with self.server.request_slots:
+                data = self.rfile.read(length)
+                try:
+                    body, content_type = self.server.executor.submit(
+                        watermark_bytes, data, args, output_format
+                    ).result()
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                finally:
+                    del data  # Free the upload before the slot is released, not after the response
+            self._send(200, body, content_type)
+
+        def send_response(self, code, message=None):
+            """Count every response by its status code."""
+            self.server.request_counts[code] += 1
+            super().send_response(code, message)
+
+        def _send(self, status, body, content_type):
+            """Send a complete response."""
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return WatermarkRequestHandler
+
+
+def request_arguments(defaults, query):
+    """Combine the server defaults with the query parameters of a request."""
+    import urllib.parse
+
+    args = copy.copy(defaults)
+    output_format = None
+    for name, value in urllib.parse.parse_qsl(query):
+        if name == 'format':
+            if value.lower() not in OUTPUT_FORMATS:
+                raise ValueError(f"Unsupported format '{value}'.")
+            output_format = value.lower()
+        elif name in REQUEST_PARAMETERS:
+            try:
+                setattr(args, name, REQUEST_PARAMETERS[name](value))
+            except ValueError:
+                raise ValueError(f"Invalid value for {name}: '{value}'.")
+            if name in REQUEST_LIMITS:
+                low, high = REQUEST_LIMITS[name]
+                if high is None and getattr(args, name) < low:
+                    raise ValueError(f"{name} must be at least {low}.")
+                if high is not None and not low <= getattr(args, name) <= high:
+                    raise ValueError(f"{name} must be between {low} and {high}.")
+        else:
+            raise ValueError(f"Unknown parameter '{name}'.")
+    if args.outline_mode not in OUTLINE_MODES:
+        raise ValueError(f"Unknown outline_mode '{args.outline_mode}'.")
+    if args.text:
+        if len(args.text) > MAX_REQUEST_TEXT_LENGTH:
+            raise ValueError(f"text must be at most {MAX_REQUEST_TEXT_LENGTH} characters.")
+        tile_pixels = rotated_tile_pixels(args.text, args.font, args.font_size, args.outline_width, args.angle)
+        if tile_pixels > MAX_REQUEST_TILE_PIXELS:
+            raise ValueError("The text is too large at this font size, use shorter text or a smaller font_size.")
+    return args, output_format
+
+
+def watermark_bytes(data, args, output_format=None):
+    """Watermark an encoded image and return the encoded result and its content type.
+
+    Without an output format, JPEG input stays JPEG and everything else becomes PNG.
+    """
+    from PIL import Image
+
+    try:
+        with profile_stage('load'):
+            source = Image.open(io.BytesIO(data))
+            base_image = convert_for_watermarking(reduce_image(source, args.long_edge))
+    except IOError:
+        raise ValueError("Unable to load image from the request body.")
+    if output_format is None:
+        output_format = 'jpeg' if source.format == 'JPEG' else 'png'
+
+    watermarked_image = composite_image(base_image, args)
+
+    image_format, content_type = OUTPUT_FORMATS[output_format]
+    return encode_image(watermarked_image, image_format, args.encoder_profile, args.optimize), content_type
+
+
+@profiled('load')
+def load_image(image_path, keep_rgb=False, long_edge=None):
+    """Load an image from the specified path.
+
+    With keep_rgb, opaque images are loaded as RGB instead of RGBA, which saves a
+    quarter of the memory and the conversions to and from RGBA around a JPEG round trip.
+    With long_edge, the image is shrunk so its longer side is at most long_edge pixels.
+    """
+    from PIL import Image
+
     if not os.path.exists(image_path):
         raise FileNotFoundError(f"The file '{image_path}' does not exist.")
     try:
-        return Image.open(image_path).convert("RGBA")
+        image = reduce_image(Image.open(image_path), long_edge)
+        if keep_rgb:
+            return convert_for_watermarking(image)
+        return image.convert("RGBA")
     except IOError:
         raise Exception(f"Unable to load image: {image_path}")
 
 
-def get_system_font():
-    """Try to find a suitable system font."""
-    # Common font locations and names
-    font_options = [
-        # Windows fonts
-        "Arial.ttf", "arial.ttf",
-        "Verdana.ttf", "verdana.ttf",
-        "Tahoma.ttf", "tahoma.ttf",
-        "Times.ttf", "times.ttf",
-        "TimesNewRoman.ttf", "timesnewroman.ttf",
-        # Linux fonts
-        "DejaVuSans.ttf", "DejaVuSans-Bold.ttf",
-        # Mac fonts
-        "Helvetica.ttf", "helvetica.ttf",
-        # System paths
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-        "/usr/share/fonts/TTF/Arial.ttf",
-        "/System/Library/Fonts/Helvetica.ttf",
-        "C:\\Windows\\Fonts\\arial.ttf",
-        "C:\\Windows\\Fonts\\verdana.ttf"
-    ]
+@profiled('load')
+def read_file(path):
+    """Read the raw bytes of an input file."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"The file '{path}' does not exist.")
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@profiled('load')
+def decode_image(data, image_path, long_edge=None):
+    """Decode the bytes of an image file read from image_path, shrunk to long_edge if given.
 
-    for font_name in font_options:
+    Opaque images are decoded to RGB and images with transparency to RGBA.
+    """
+    from PIL import Image
+
+    try:
+        return convert_for_watermarking(reduce_image(Image.open(io.BytesIO(data)), long_edge))
+    except IOError:
+        raise Exception(f"Unable to load image: {image_path}")
+
+
+def convert_for_watermarking(image):
+    """Convert an image to RGBA if it has transparency and to RGB otherwise.
+
+    RGBA watermarks are pasted onto RGB images directly, so opaque images never
+    need an alpha channel. Images that already have the right mode are not copied.
+    """
+    has_alpha = image.mode in ('RGBA', 'RGBa', 'LA', 'La', 'PA') or 'transparency' in image.info
+    mode = 'RGBA' if has_alpha else 'RGB'
+    if image.mode == mode:
+        image.load()
+        return image
+    return image.convert(mode)
+
+
+def reduced_size(size, long_edge):
+    """Return the size of an image shrunk so its longer side is at most long_edge."""
+    width, height = size
+    if long_edge is None or max(width, height) <= long_edge:
+        return size
+    if long_edge < 1:
+        raise ValueError("--long-edge must be a positive number of pixels.")
+    scale = long_edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def reduce_image(image, long_edge):
+    """Shrink a freshly opened image so its longer side is at most long_edge.
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale with draft(), keeping at
+    least twice the target size, and resize() then uses reduce() to average
+    down by whole factors before the final Lanczos resampling.
+    """
+    from PIL import Image
+
+    size = reduced_size(image.size, long_edge)
+    if size == image.size:
+        return image
+    image.draft(None, (size[0] * 2, size[1] * 2))
+    if image.mode in ('1', 'P'):
+        # Palette images would otherwise be resized with nearest neighbour
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image.resize(size, Image.LANCZOS, reducing_gap=2.0)
+
+
+def get_system_font(font_size=12):
+    """Return a suitable system font at the requested size."""
+    from PIL import ImageFont
+
+    font_path = find_system_font_path()
+    if font_path:
+        return load_font(font_path, font_size)
+
+    # If all fonts fail, fall back to default
+    try:
+        return ImageFont.load_default(font_size)
+    except TypeError:  # Pillow before 10.1 only has the fixed-size bitmap font
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def load_font(font_path, font_size):
+    """Load a TrueType font, reusing fonts that were already loaded."""
+    from PIL import ImageFont
+
+    return ImageFont.truetype(font_path, font_size)
+
+
+@functools.lru_cache(maxsize=None)
+def find_system_font_path():
+    """Find the best available system font once per process.
+
+    The resolved path is remembered on disk, so later runs skip probing the candidates.
+    """
+    from PIL import ImageFont
+
+    try:
+        with open(FONT_PATH_CACHE_FILE, encoding='utf-8') as cache_file:
+            cached_path = cache_file.read().strip()
+        if cached_path and os.path.isfile(cached_path):
+            return cached_path
+    except OSError:
+        pass
+
+    for font_name in SYSTEM_FONT_CANDIDATES:
         try:
-            return ImageFont.truetype(font_name, 12)  # Test with a small size
+            # Pillow searches the system font directories for bare file names
+            font_path = ImageFont.truetype(font_name, 12).path
         except IOError:
             continue
+        font_path = os.path.abspath(font_path)
 
-    # If all fonts fail, fall back to default
-    return ImageFont.load_default()
-
+        try:
+            os.makedirs(os.path.dirname(FONT_PATH_CACHE_FILE), exist_ok=True)
+            with open(FONT_PATH_CACHE_FILE, 'w', encoding='utf-8') as cache_file:
+                cache_file.write(font_path)
+        except OSError:
+            pass  # The cache only speeds up the next run
+        return font_path
+
+    return None
+
+
+def _outline_coverage(text, font, size, padding, outline_width):
+    """Return the coverage of the text drawn at every offset of the outline square except the center.
+
+    Drawing the text once per offset leaves 1 - prod(1 - a) of coverage. The product
+    over the square splits into one along the rows and one along the columns, which
+    takes about 6 * outline_width multiplications of the glyph mask instead of
+    (2 * outline_width + 1) ** 2 - 1 text draws.
+    """
+    from PIL import Image, ImageChops, ImageDraw
+
+    # Offsets move glyph parts from outside the image into it, so the mask has a margin
+    width, height = size
+    margin = outline_width
+    glyph = Image.new('L', (width + 2 * margin, height + 2 * margin), 0)
+    ImageDraw.Draw(glyph).text((padding + margin, padding + margin), text, font=font, fill=255)
+    clear = ImageChops.invert(glyph)  # 255 - a, the products of these stay uncovered
+
+    def shifted(image, dx, dy):
+        result = Image.new('L', image.size, 255)
+        result.paste(image, (dx, dy))
+        return result
+
+    # Along the rows, with the center for the outer rows and without it for the middle row
+    row = clear
+    middle_row = None
+    for dx in range(1, outline_width + 1):
+        for shift in (dx, -dx):
+            part = shifted(clear, shift, 0)
+            row = ImageChops.multiply(row, part)
+            middle_row = part if middle_row is None else ImageChops.multiply(middle_row, part)
+
+    # Then along the columns
+    uncovered = middle_row
+    for dy in range(1, outline_width + 1):
+        for shift in (dy, -dy):
+            uncovered = ImageChops.multiply(uncovered, shifted(row, 0, shift))
+    return ImageChops.invert(uncovered).crop((margin, margin, margin + width, margin + height))
+
+
+@profiled('tile_render')
+def create_single_text_watermark(text, font, font_size, font_color, outline_color, outline_width,
+                                 outline_mode=DEFAULT_OUTLINE_MODE):
+    """Create a single instance of the text watermark.
+
+    The outline is drawn with one of the OUTLINE_MODES: 'offset' draws the text
+    once per offset, which gets slow for wide outlines, 'dilate' builds the same
+    outline from one glyph mask and 'stroke' uses FreeType's native stroking.
+    """
+    from PIL import Image, ImageColor, ImageDraw
 
-def create_single_text_watermark(text, font, font_size, font_color, outline_color, outline_width):
-    """Create a single instance of the text watermark."""
     # Create a temporary transparent image
     temp_img = Image.new('RGBA', (1, 1), (255, 255, 255, 0))
     temp_draw = ImageDraw.Draw(temp_img)
@@ -231,8 +1468,18 @@ def create_single_text_watermark(text, font, font_size, font_color, outline_colo
         print(f"Warning: Invalid outline color '{outline_color}'. Using black.")
         outline_color_rgb = (0, 0, 0, 255)
 
-    # Draw outline by drawing text multiple times with offsets
-    if outline_width > 0:
+    if outline_width > 0 and outline_mode == 'stroke':
+        # FreeType strokes the glyphs in the same pass that fills them
+        draw.text((padding, padding), text, font=font, fill=font_color_rgb,
+                  stroke_width=outline_width, stroke_fill=outline_color_rgb)
+        return text_img
+
+    if outline_width > 0 and outline_mode == 'dilate':
+        # Blend the outline color in once with the coverage all offset drawings add up to
+        outline_mask = _outline_coverage(text, font, text_img.size, padding, outline_width)
+        text_img.paste(outline_color_rgb, mask=outline_mask)
+    elif outline_width > 0:
+        # Draw outline by drawing text multiple times with offsets
         for offset_x in range(-outline_width, outline_width + 1):
             for offset_y in range(-outline_width, outline_width + 1):
                 if offset_x == 0 and offset_y == 0:
@@ -246,31 +1493,301 @@ def create_single_text_watermark(text, font, font_size, font_color, outline_colo
 
 
 def create_photo_text_watermark(base_size, text, font_path, font_size, font_color,
-                                outline_color, outline_width, angle, density):
-    """Create a diagonal repeating text watermark pattern across the entire image."""
-    base_width, base_height = base_size
+                                outline_color, outline_width, angle, density,
+                                outline_mode=DEFAULT_OUTLINE_MODE, opacity=1.0):
+    """Create a diagonal repeating text watermark pattern across the entire image.
+
+    An opacity below 1 is applied to the single text before tiling, which gives
+    exactly the pattern set_opacity would give on the result. The pattern is cached
+    per parameter set and the cached image itself is returned, callers must not
+    change it in place. set_opacity and apply_watermark leave it untouched.
+    """
+    return _render_text_pattern(
+        tuple(base_size), text, font_path, font_size, font_color,
+        outline_color, outline_width, angle, density, outline_mode, opacity
+    )
+
+
+def create_photo_text_watermark_region(box, text, font_path, font_size, font_color,
+                                       outline_color, outline_width, angle, density,
+                                       outline_mode=DEFAULT_OUTLINE_MODE, opacity=1.0):
+    """Create only the part of the text watermark pattern inside box.
+
+    The pattern is anchored at the top-left corner of the image, so this matches
+    create_photo_text_watermark(...).crop(box) for any image that contains the box.
+    """
+    from PIL import Image
+
+    rotated_text, (start_x, start_y), row_step, line_step = _text_lattice(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, density, outline_mode
+    )
+    left, top, right, bottom = box
+    region = Image.new('RGBA', (right - left, bottom - top), (255, 255, 255, 0))
+
+    origin = (start_x - left, start_y - top)
+    faded = _faded_tile(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, density, outline_mode, opacity
+    ) if opacity < 1.0 else None
+    if faded:
+        tile, coverage = faded
+        _tile_lattice(region, tile, origin, row_step, line_step, coverage)
+        return region
+
+    # Copies of the text overlap, their blend has to be faded as a whole
+    _tile_lattice(region, rotated_text, origin, row_step, line_step, rotated_text, opacity)
+    return region
+
+
+def composite_text_watermark(base_image, text, font_path, font_size, font_color,
+                             outline_color, outline_width, angle, density, opacity,
+                             outline_mode=DEFAULT_OUTLINE_MODE):
+    """Paste the repeating text watermark straight onto base_image, in place.
+
+    Instead of full-size pattern and opacity layers, the rotated text is prepared
+    once as it would appear in the opacity-adjusted pattern and pasted at every
+    lattice point. The result matches apply_watermark with the full-size pattern
+    wherever copies of the text do not overlap.
+    """
+    rotated_text, origin, row_step, line_step = _text_lattice(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, density, outline_mode
+    )
+    tile = _render_ready_tile(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, outline_mode, opacity
+    )
+    with profile_stage('composite'):
+        _paste_lattice(base_image, tile, origin, row_step, line_step, (0, 0))
+    return base_image
+
+
+@functools.lru_cache(maxsize=TILE_CACHE_SIZE)
+def _render_ready_tile(text, font_path, font_size, font_color, outline_color, outline_width, angle,
+                       outline_mode, opacity):
+    """Render the rotated text as one copy of it looks in the opacity-adjusted pattern."""
+    from PIL import Image
+
+    _, rotated_text = _render_rotated_text(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, outline_mode
+    )
+    # Pasting onto the transparent pattern background changes the colors and alpha at the edges
+    tile = Image.new('RGBA', rotated_text.size, (255, 255, 255, 0))
+    tile.paste(rotated_text, (0, 0), rotated_text)
+    return set_opacity(tile, opacity)
+
+
+@functools.lru_cache(maxsize=TILE_CACHE_SIZE)
+def _faded_tile(text, font_path, font_size, font_color, outline_color, outline_width, angle, density,
+                outline_mode, opacity):
+    """Return the text as it looks in the opacity-adjusted pattern and the mask it is pasted with.
+
+    Where copies of the text do not overlap, every pattern pixel comes from one copy
+    on the transparent background. Copying the faded tile wherever its text is
+    visible then gives exactly set_opacity on the whole pattern. Returns None when
+    copies overlap on the lattice.
+    """
+    from PIL import ImageChops
+
+    rotated_text, _, row_step, line_step = _text_lattice(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, density, outline_mode
+    )
+    coverage = rotated_text.getchannel('A').point(lambda value: 255 if value else 0)
+    width, height = coverage.size
+
+    # Check every lattice vector that shifts a copy by less than the tile size
+    det = line_step[0] * row_step[1] - line_step[1] * row_step[0]
+    corners = [(x, y) for x in (-width, width) for y in (-height, height)]
+    i_coords = [(x * row_step[1] - y * row_step[0]) / det for x, y in corners]
+    j_coords = [(y * line_step[0] - x * line_step[1]) / det for x, y in corners]
+    for i in range(math.floor(min(i_coords)), math.ceil(max(i_coords)) + 1):
+        for j in range(math.floor(min(j_coords)), math.ceil(max(j_coords)) + 1):
+            dx = i * line_step[0] + j * row_step[0]
+            dy = i * line_step[1] + j * row_step[1]
+            if (i, j) == (0, 0) or abs(dx) >= width or abs(dy) >= height:
+                continue
+            box = (max(0, dx), max(0, dy), min(width, width + dx), min(height, height + dy))
+            shifted_box = (box[0] - dx, box[1] - dy, box[2] - dx, box[3] - dy)
+            if ImageChops.multiply(coverage.crop(box), coverage.crop(shifted_box)).getbbox():
+                return None
+
+    tile = _render_ready_tile(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, outline_mode, opacity
+    )
+    return tile, coverage
+
+
+def clear_watermark_cache():
+    """Drop all cached fonts, text tiles and patterns."""
+    load_font.cache_clear()
+    find_system_font_path.cache_clear()
+    _render_rotated_text.cache_clear()
+    _render_ready_tile.cache_clear()
+    _faded_tile.cache_clear()
+    _file_hash.cache_clear()
+    clear_pattern_cache()
+
+
+def cached_text_watermark(cache_dir, cache_size, base_size, text, font_path, font_size, font_color,
+                          outline_color, outline_width, angle, density,
+                          outline_mode=DEFAULT_OUTLINE_MODE, opacity=1.0):
+    """Return the text watermark from the on-disk layer cache, rendering and storing it on a miss.
+
+    Layers are stored as raw RGBA pixels named after a hash of everything that
+    affects them and are memory-mapped on a hit, so loading costs no decoding and
+    processes share the pages. The least recently used layers are removed once
+    the cache holds more than cache_size MB. The returned image is read-only.
+    """
+    key = layer_cache_key(base_size, text, font_path, font_size, font_color, outline_color,
+                          outline_width, angle, density, outline_mode, opacity)
+    layer_path = os.path.join(cache_dir, key + '.rgba')
+    try:
+        layer = _map_layer(layer_path, base_size)
+        os.utime(layer_path)  # Mark as recently used
+        return layer
+    except (OSError, ValueError):
+        pass  # Missing or incomplete, render it again
+
+    layer = create_photo_text_watermark(base_size, text, font_path, font_size, font_color,
+                                        outline_color, outline_width, angle, density, outline_mode, opacity)
+    try:
+        _store_layer(layer, cache_dir, layer_path)
+        _evict_layers(cache_dir, cache_size)
+    except OSError:
+        pass  # The cache only speeds up later runs
+    return layer
+
+
+def layer_cache_key(base_size, text, font_path, font_size, font_color, outline_color,
+                    outline_width, angle, density, outline_mode, opacity):
+    """Return the name of a cached layer, a hash of everything the layer depends on.
+
+    The font is identified by the contents of its file, so a replaced font file gets new layers.
+    """
+    import hashlib
+    from PIL import Image
+
+    font, _ = _load_font(font_path, font_size)
+    font_file = getattr(font, 'path', None)
+    font_hash = _file_hash(font_file) if isinstance(font_file, str) else 'default'
+    parts = (LAYER_CACHE_VERSION, Image.__version__, tuple(base_size), text, font_hash, font_size,
+             font_color, outline_color, outline_width, angle, density, outline_mode, opacity)
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+@functools.lru_cache(maxsize=FONT_CACHE_SIZE)
+def _file_hash(path):
+    """Return the SHA-256 of a file's contents, once per process."""
+    import hashlib
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _map_layer(layer_path, size):
+    """Memory-map a stored layer as a read-only RGBA image."""
+    from PIL import Image
+
+    with open(layer_path, 'rb') as layer_file:
+        mapped = mmap.mmap(layer_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return Image.frombuffer('RGBA', size, mapped, 'raw', 'RGBA', 0, 1)
+
+
+def _store_layer(layer, cache_dir, layer_path):
+    """Write a layer's raw pixels, renaming the finished file into place so readers never see half of it."""
+    import tempfile
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as layer_file:
+            for top in range(0, layer.height, LAYER_WRITE_ROWS):
+                layer_file.write(layer.crop((0, top, layer.width, min(top + LAYER_WRITE_ROWS, layer.height))).tobytes())
+        os.replace(temp_path, layer_path)
+    except OSError:
+        os.remove(temp_path)
+        raise
+
+
+def _evict_layers(cache_dir, cache_size):
+    """Remove the least recently used layers until the cache fits in cache_size MB."""
+    layers = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.rgba'):
+            stat = entry.stat()
+            layers.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in layers)
+    for _, size, path in sorted(layers):
+        if total <= cache_size * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue  # Removed by another process, or still mapped on Windows
+        total -= size
+
+
+@profiled('font')
+def rotated_tile_pixels(text, font_path, font_size, outline_width, angle):
+    """Return the pixel count of the rotated text tile, measured without rendering it."""
+    from PIL import Image, ImageDraw
+
+    font, _ = _load_font(font_path, font_size)
+    left, top, right, bottom = ImageDraw.Draw(Image.new('L', (1, 1))).textbbox((0, 0), text, font=font)
+    padding = outline_width * 2
+    width, height = right - left + padding * 2, bottom - top + padding * 2
+    angle_rad = math.radians(angle)
+    cos, sin = abs(math.cos(angle_rad)), abs(math.sin(angle_rad))
+    return (width * cos + height * sin) * (width * sin + height * cos)
+
+
+def _load_font(font_path, font_size):
+    """Load the watermark font, falling back to a system font."""
+    from PIL import ImageFont
 
-    # Load font
     try:
         if font_path:
-            font = ImageFont.truetype(font_path, font_size)
+            font = load_font(font_path, font_size)
         else:
-            font = get_system_font()
+            font = get_system_font(font_size)
             if isinstance(font, ImageFont.ImageFont):  # If it's the default PIL font
                 # Scale default font size (it's usually small)
                 font_size = int(font_size * 1.5)
     except IOError:
         print(f"Warning: Could not load font from {font_path}. Using system font.")
-        font = get_system_font()
+        font = get_system_font(font_size)
+    return font, font_size
+
+
+@functools.lru_cache(maxsize=TILE_CACHE_SIZE)
+def _render_rotated_text(text, font_path, font_size, font_color, outline_color, outline_width, angle,
+                         outline_mode):
+    """Render a single text watermark and return it unrotated and rotated."""
+    from PIL import Image
+
+    font, font_size = _load_font(font_path, font_size)
 
     # Create a single text watermark
     single_text = create_single_text_watermark(
-        text, font, font_size, font_color, outline_color, outline_width
+        text, font, font_size, font_color, outline_color, outline_width, outline_mode
     )
 
-    # Calculate spacing based on density and image size
+    # Rotate the text for diagonal placement
+    with profile_stage('rotate'):
+        rotated_text = single_text.rotate(angle, expand=True, resample=Image.BICUBIC)
+    return single_text, rotated_text
+
+
+def _text_lattice(text, font_path, font_size, font_color, outline_color, outline_width, angle, density,
+                  outline_mode):
+    """Return the rotated text and the lattice it is repeated on.
+
+    The lattice is origin + i * line_step + j * row_step in image coordinates.
+    """
+    single_text, rotated_text = _render_rotated_text(
+        text, font_path, font_size, font_color, outline_color, outline_width, angle, outline_mode
+    )
+
+    # Calculate spacing based on density
     # Higher density = smaller spacing between watermarks
-    diagonal_length = math.sqrt(base_width ** 2 + base_height ** 2)
     spacing_factor = 1.0 - density  # Invert density (higher density = lower spacing)
     spacing_factor = max(0.2, min(1.0, spacing_factor))  # Clamp between 0.2 and 1.0
 
@@ -278,14 +1795,6 @@ def create_photo_text_watermark(base_size, text, font_path, font_size, font_colo
     text_width, text_height = single_text.size
     base_spacing = int(max(text_width, text_height) * 2.5 * spacing_factor)  # Base spacing is 2.5x text size
 
-    # Create pattern canvas (larger than image to ensure full coverage)
-    # Calculate pattern size with enough margin
-    pattern_width = base_width + (2 * text_width)
-    pattern_height = base_height + (2 * text_height)
-    pattern = Image.new('RGBA', (pattern_width, pattern_height), (255, 255, 255, 0))
-
-    # Rotate the text for diagonal placement
-    rotated_text = single_text.rotate(angle, expand=True, resample=Image.BICUBIC)
     rotated_width, rotated_height = rotated_text.size
 
     # Calculate grid parameters for placing the watermarks
@@ -298,50 +1807,174 @@ def create_photo_text_watermark(base_size, text, font_path, font_size, font_colo
     perp_dx = int(math.cos(angle_rad + math.pi / 2) * base_spacing)
     perp_dy = int(math.sin(angle_rad + math.pi / 2) * base_spacing)
 
-    # Calculate how many lines we need
-    diagonal_count = int(diagonal_length / base_spacing) * 2  # Multiply by 2 for safety
-
-    # Start position (negative offsets to ensure coverage)
-    start_x = -rotated_width
-    start_y = -rotated_height
-
-    # Create diagonal lines of text
-    for i in range(-diagonal_count, diagonal_count):
-        line_start_x = start_x + (i * perp_dx)
-        line_start_y = start_y + (i * perp_dy)
-
-        # Calculate how many texts to place on this line
-        line_length = diagonal_length * 1.5  # Extra length for safety
-        text_count = int(line_length / base_spacing) + 1
-
-        for j in range(text_count):
-            x = line_start_x + (j * dx)
-            y = line_start_y + (j * dy)
-
-            # Only place if within or near the pattern bounds
-            if (-rotated_width <= x <= pattern_width and
-                    -rotated_height <= y <= pattern_height):
-                pattern.paste(rotated_text, (x, y), rotated_text)
-
-    # Crop the pattern to match the base image size
-    left = (pattern_width - base_width) // 2
-    top = (pattern_height - base_height) // 2
-    right = left + base_width
-    bottom = top + base_height
-
-    return pattern.crop((left, top, right, bottom))
+    # Start position (negative offsets to ensure coverage), shifted by the
+    # margin the pattern used to be cropped by
+    start_x = -rotated_width - text_width
+    start_y = -rotated_height - text_height
+
+    return rotated_text, (start_x, start_y), (dx, dy), (perp_dx, perp_dy)
+
+
+_pattern_cache = collections.OrderedDict()  # Least recently used first
+_pattern_cache_bytes = 0
+_pattern_cache_lock = threading.Lock()
+
+
+def _render_text_pattern(*key):
+    """Render the pattern straight at the image size, tiles at the edges are clipped by paste.
+
+    Patterns are cached by their parameters, least recently used ones are dropped
+    once the cache holds more than PATTERN_CACHE_MB. A pattern bigger than that is
+    not cached at all.
+    """
+    global _pattern_cache_bytes
+    with _pattern_cache_lock:
+        if key in _pattern_cache:
+            _pattern_cache.move_to_end(key)
+            return _pattern_cache[key]
+
+    base_size = key[0]
+    pattern = create_photo_text_watermark_region((0, 0) + tuple(base_size), *key[1:])
+
+    pattern_bytes = base_size[0] * base_size[1] * 4
+    limit = PATTERN_CACHE_MB * 1024 * 1024
+    if pattern_bytes <= limit:
+        with _pattern_cache_lock:
+            if key not in _pattern_cache:
+                _pattern_cache[key] = pattern
+                _pattern_cache_bytes += pattern_bytes
+            while _pattern_cache_bytes > limit:
+                old_key, _ = _pattern_cache.popitem(last=False)
+                old_width, old_height = old_key[0]
+                _pattern_cache_bytes -= old_width * old_height * 4
+    return pattern
+
+
+def clear_pattern_cache():
+    """Drop the cached full-size patterns."""
+    global _pattern_cache_bytes
+    with _pattern_cache_lock:
+        _pattern_cache.clear()
+        _pattern_cache_bytes = 0
+
+
+@profiled('tile_placement')
+def _tile_lattice(canvas, tile, origin, row_step, line_step, mask=None, opacity=1.0):
+    """Fill the canvas with the tile repeated on the lattice origin + i * line_step + j * row_step.
+
+    Every copy is pasted with mask, or with the tile itself when no mask is given. With
+    opacity below 1 the blend of the copies is faded as a whole, which the canvas must
+    start out transparent for.
+
+    The pattern is periodic, so only one band is rendered tile by tile. Every other
+    band is a shifted copy of it, which keeps the work proportional to the pixels.
+    """
+    from PIL import Image
+
+    canvas_width, canvas_height = canvas.size
+
+    # Pick the lattice vector that makes the seed band cheapest to render
+    candidates = [
+        row_step, line_step,
+        (row_step[0] + line_step[0], row_step[1] + line_step[1]),
+        (row_step[0] - line_step[0], row_step[1] - line_step[1]),
+    ]
+    candidates = [(-x, -y) if y < 0 else (x, y) for x, y in candidates]
+    candidates = [(x, y) for x, y in candidates if y > 0]
+    if candidates:
+        band_dx, band_dy = min(candidates, key=lambda v: v[1] * canvas_width + abs(v[0]) * canvas_height)
+    if not candidates or band_dy >= canvas_height:
+        _paste_lattice(canvas, tile, origin, row_step, line_step, (0, 0), mask)
+        if opacity < 1.0:
+            canvas.paste(set_opacity(canvas, opacity))
+        return
+
+    # The seed band must be wide enough to be shifted across the full height
+    band_count = -(-canvas_height // band_dy)
+    shift = (band_count - 1) * band_dx
+    seed_left = min(0, -shift)
+    seed = Image.new(canvas.mode, (canvas_width + abs(shift), band_dy), (255, 255, 255, 0))
+    _paste_lattice(seed, tile, origin, row_step, line_step, (seed_left, 0), mask)
+    if opacity < 1.0:  # The band copies below are pasted without a mask, so fading the seed is exact
+        seed = set_opacity(seed, opacity)
+
+    for k in range(band_count):
+        canvas.paste(seed, (seed_left + k * band_dx, k * band_dy))
+    _count_lattice(band_copies=band_count)
+
+
+# Lattice lines visited, tiles pasted and skipped by _paste_lattice and seed band copies
+# by _tile_lattice since the last reset, for benchmarks and profiles
+lattice_counters = collections.Counter()
+
+
+def _paste_lattice(canvas, tile, origin, row_step, line_step, offset, mask=None):
+    """Paste the tile at every lattice point that touches the canvas, line by line.
+
+    The canvas covers the lattice coordinates starting at offset.
+    """
+    canvas_width, canvas_height = canvas.size
+    tile_width, tile_height = tile.size
+    if mask is None:
+        mask = tile
+    left, top = offset[0] - origin[0], offset[1] - origin[1]
+    right, bottom = left + canvas_width, top + canvas_height
+
+    # Solve p = i * line_step + j * row_step at the corners of the area where tiles are visible
+    det = line_step[0] * row_step[1] - line_step[1] * row_step[0]
+    corners = [(x, y) for x in (left - tile_width, right) for y in (top - tile_height, bottom)]
+    i_coords = [(x * row_step[1] - y * row_step[0]) / det for x, y in corners]
+    j_coords = [(y * line_step[0] - x * line_step[1]) / det for x, y in corners]
+
+    first_j, last_j = math.floor(min(j_coords)), math.ceil(max(j_coords))
+    lines = pastes = skipped = 0
+    for i in range(math.floor(min(i_coords)), math.ceil(max(i_coords)) + 1):
+        line_x = i * line_step[0] - left
+        line_y = i * line_step[1] - top
+        # Exactly the tiles of this line that overlap the canvas horizontally and vertically
+        first_x, last_x = _lattice_range(line_x, row_step[0], -tile_width, canvas_width)
+        first_y, last_y = _lattice_range(line_y, row_step[1], -tile_height, canvas_height)
+        first, last = max(first_x, first_y), min(last_x, last_y)
+        for j in range(first, last + 1):
+            canvas.paste(tile, (line_x + j * row_step[0], line_y + j * row_step[1]), mask)
+        # Points of the bounding parallelogram that were never tried because they miss the canvas
+        pasted = max(0, last - first + 1)
+        lines += 1
+        pastes += pasted
+        skipped += last_j - first_j + 1 - pasted
+    _count_lattice(lines=lines, pastes=pastes, skipped=skipped)
+
+
+def _count_lattice(**counts):
+    """Add to the lattice counters, band threads and server requests tile at the same time."""
+    with _profile_lock:
+        lattice_counters.update(counts)
+
+
+def _lattice_range(start, step, low, high):
+    """Return the first and last j with low < start + j * step < high, first > last if there is none."""
+    if step == 0:
+        return (-math.inf, math.inf) if low < start < high else (1, 0)
+    if step < 0:
+        start, step, low, high = -start, -step, -high, -low
+    return (low - start) // step + 1, -((start - high) // step) - 1
 
 
 def resize_watermark(base_image, watermark, scale_factor):
     """Resize the watermark image relative to the base image."""
+    from PIL import Image
+
     base_width, base_height = base_image.size
     watermark_width = int(base_width * scale_factor)
     watermark_height = int(watermark.size[1] * (watermark_width / watermark.size[0]))
     return watermark.resize((watermark_width, watermark_height), Image.LANCZOS)
 
 
+@profiled('opacity')
 def set_opacity(watermark, opacity):
     """Adjust the opacity of the watermark."""
+    from PIL import Image
+
     watermark = watermark.copy()
     alpha = watermark.split()[3]
     alpha = Image.blend(Image.new('L', watermark.size, 0), alpha, opacity)
@@ -366,23 +1999,155 @@ def calculate_position(base_image, watermark, position):
         return ((base_width - watermark_width) // 2, (base_height - watermark_height) // 2)
 
 
-def apply_watermark(base_image, watermark, position):
-    """Overlay the watermark on the base image at the specified position."""
+@profiled('composite')
+def apply_watermark(base_image, watermark, position, opacity=1.0, backend=DEFAULT_BACKEND):
+    """Overlay the watermark on the base image at the specified position.
+
+    An opacity below 1 is applied on the way, so the watermark does not need to go
+    through set_opacity first. The numpy backend scales the alpha and composites
+    in a single pass without the intermediate full-size images.
+    """
+    if backend == 'numpy':
+        return _apply_watermark_numpy(base_image, watermark, position, opacity)
+
+    if opacity < 1.0:
+        watermark = set_opacity(watermark, opacity)
     result = base_image.copy()
     result.paste(watermark, position, watermark)
     return result
 
 
-def save_image(image, output_path):
-    """Save the processed image to the specified output path."""
-    # Create output directory if it doesn't exist
-    output_dir = os.path.dirname(output_path)
-    if output_dir and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+@functools.lru_cache(maxsize=None)
+def import_numpy():
+    """Import NumPy on first use and return it, or None if it is not installed."""
+    try:
+        import numpy
+    except ImportError:  # NumPy is optional, only the numpy backend needs it
+        return None
+    return numpy
+
 
-    if output_path.lower().endswith(('.jpg', '.jpeg')):
+def _apply_watermark_numpy(base_image, watermark, position, opacity):
+    """Scale the watermark alpha and composite it onto a copy of the base image with NumPy.
+
+    The images are processed in strips, and only pixels under a visible part of
+    the watermark are blended, so the result array is the only full-size
+    allocation. The rounding matches Image.blend and Image.paste, which makes
+    the result identical to the PIL backend.
+    """
+    from PIL import Image
+
+    np = import_numpy()
+    if np is None:
+        raise ImportError("The numpy backend requires NumPy to be installed.")
+    if base_image.mode not in ('RGB', 'RGBA') or watermark.mode != 'RGBA':
+        raise ValueError("The numpy backend only composites RGBA watermarks onto RGB or RGBA images.")
+
+    base_width, base_height = base_image.size
+    x, y = position
+    channels = len(base_image.mode)
+    result = np.empty((base_height, base_width, channels), dtype=np.uint8)
+
+    # Same truncation as Image.blend, looked up instead of computed per pixel
+    opacity_table = (np.arange(256, dtype=np.float32) * np.float32(opacity)).astype(np.uint16)
+
+    for top in range(0, base_height, NUMPY_STRIP_HEIGHT):
+        bottom = min(top + NUMPY_STRIP_HEIGHT, base_height)
+        target = result[top:bottom]
+        target[...] = np.asarray(base_image.crop((0, top, base_width, bottom)))
+        if bottom <= y or top >= y + watermark.height:
+            continue
+
+        # Crop boxes outside the watermark are padded with transparent pixels
+        source = np.asarray(watermark.crop((-x, top - y, base_width - x, bottom - y)))
+        mask = opacity_table[source[..., 3]]
+        visible = np.nonzero(mask)
+        if not len(visible[0]):
+            continue
+
+        # The scaled alpha doubles as the paste mask, then the same rounded division as Image.paste
+        mask = mask[visible][:, None]
+        pixels = source[visible][:, :channels].astype(np.uint16)
+        if channels == 4:
+            pixels[:, 3:] = mask
+        blended = target[visible] * (255 - mask) + pixels * mask + 128
+        target[visible] = (blended + (blended >> 8)) >> 8
+
+    return Image.fromarray(result)
+
+
+def save_image(image, output_path, profile=DEFAULT_ENCODER_PROFILE, optimize=True):
+    """Save the processed image straight to the specified output path and return its encode stats."""
+    image_format = output_format(output_path)
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    encode_image(image, image_format, profile, optimize, output_path)
+    stats = {
+        'output': output_path,
+        'format': image_format,
+        'encode_seconds': round(time.perf_counter() - start, 4),
+        'bytes': os.path.getsize(output_path),
+    }
+    return stats
+
+
+def output_format(output_path):
+    """Return the Pillow format name for the extension of output_path."""
+    from PIL import Image
+
+    image_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+    if image_format is None:
+        raise ValueError(f"Unknown output format for {output_path}")
+    return image_format
+
+
+def encode_for_path(image, output_path, profile=DEFAULT_ENCODER_PROFILE, optimize=True):
+    """Encode an image into memory in the format given by the extension of output_path.
+
+    Used by the pipeline, which encodes and writes in separate stages.
+    Returns the encoded bytes and a dict with the output path, format, encode time and size.
+    """
+    image_format = output_format(output_path)
+    start = time.perf_counter()
+    data = encode_image(image, image_format, profile, optimize)
+    stats = {
+        'output': output_path,
+        'format': image_format,
+        'encode_seconds': round(time.perf_counter() - start, 4),
+        'bytes': len(data),
+    }
+    return data, stats
+
+
+@profiled('encode')
+def encode_image(image, image_format, profile=DEFAULT_ENCODER_PROFILE, optimize=True, output_path=None):
+    """Encode an image with the settings of an encoder profile.
+
+    Saves to output_path when given, otherwise returns the encoded bytes.
+    """
+    options = dict(ENCODER_PROFILES[profile].get(image_format, {}))
+    if not optimize:
+        options.pop('optimize', None)
+    if image_format == 'JPEG' and image.mode != 'RGB':
         image = image.convert('RGB')
-    image.save(output_path)
+    if output_path is not None:
+        image.save(output_path, format=image_format, **options)
+        return None
+    output = io.BytesIO()
+    image.save(output, format=image_format, **options)
+    return output.getvalue()
+
+
+@profiled('write')
+def write_file(path, data):
+    """Write encoded image bytes to path, creating its directory if needed."""
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
 
 
 if __name__ == "__main__":